@@ -18,13 +18,12 @@ __status__ = 'Development'
 
 import os
 import os.path
-import shlex
 import sys
-import glob
 import argparse
-import subprocess
 import re
 import logging
+import multiprocessing
+import StringIO
 
 try:
 	import pandas as pd
@@ -33,10 +32,23 @@ except ImportError:
 	'Please install with """pip install pandas""" and try again')
 
 try:
-	import qiime
+	import numpy as np
 except ImportError:
-	raise ImportError('The module """QIIME"" was not found! '
-	'Use either MacQIIME or """pip install qiime""" before running the command. If using MacQIIME, start the macqiime environment first before running the command.')
+	raise ImportError('The module """numpy"" was not found! '
+	'Please install with """pip install numpy""" and try again')
+
+"""LEfSe scripts are importable from the source tree or from the install location"""
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lefse_src'))
+import lefse
+import format_input
+import run_lefse
+import plot_cladogram
+import biom_table
+import stage_cache
+
+"""Parameters of run_lefse.py the statistical tests and the effect size step depend on"""
+TEST_PARAMS = ['anova_alpha', 'wilcoxon_alpha', 'strict', 'min_c', 'only_same_subcl', 'curv', 'wilc', 'engine']
+RANK_PARAMS = ['rank_tec', 'n_boots', 'f_boots', 'nlogs', 'svm_norm', 'engine']
 
 
 def get_args():
@@ -50,7 +62,7 @@ def get_args():
 	parser.add_argument('-i', '--input', action = "store", dest = "input_biom", help = 'Location of the OTU Table for main analysis. (Must be .biom format)', required = True, type=str)
 	parser.add_argument('-o', '--output', action = "store", dest = "outputDir", help = 'Location of the folder to place all resulting files. If folder does not exist, the program will create it.', required = True, type=str)
 	parser.add_argument('-m', '--map', action = "store", dest = "map_fp", help = 'Location of the mapping file associated with OTU Table.', required = True, type=str)
-	parser.add_argument('-l', '--level', action = "store", dest = "level", default = 6, help = 'Level for which to use for summarize_taxa.py. [default = 6]', type=int, choices=[2,3,4,5,6,7])
+	parser.add_argument('-l', '--level', action = "store", dest = "level", default = ['6'], nargs = '+', help = 'Taxonomy level(s) at which to summarize the OTU table. Give several levels or "all" (2-7) to analyze them from one table load. [default = 6]', type=str, choices=['2','3','4','5','6','7','all'])
 
 
 	"""Arguments for LEfSe inputs"""
@@ -60,9 +72,9 @@ def get_args():
 
 
 	"""Arguments for LEfSe discriminant analysis"""
-	parser.add_argument('-p', '--pval', action = "store", dest = "p_cutoff", default = 0.05, help = 'Change alpha value for the Anova test (default 0.05)')
-	parser.add_argument('-e','--effect', action = "store", dest = "lda_cutoff", default = 2, help = 'Change the cutoff for logarithmic                  LDA score (default 2.0).', type = float)
-	parser.add_argument('-str', '--strict', action = "store", dest = "strictness", default = 0, choices=[0,1], help = 'Change the strictness of the comparisons. Can be changed to less strict (1). [default = 0](more-strict).', type = int)
+	parser.add_argument('-p', '--pval', action = "store", dest = "p_cutoff", default = [0.05], nargs = '+', help = 'Change alpha value for the Anova test (default 0.05). Several values, as for --effect and --strict, sweep every combination of them.', type = float)
+	parser.add_argument('-e','--effect', action = "store", dest = "lda_cutoff", default = [2.0], nargs = '+', help = 'Change the cutoff for logarithmic                  LDA score (default 2.0).', type = float)
+	parser.add_argument('-str', '--strict', action = "store", dest = "strictness", default = [0], nargs = '+', choices=[0,1], help = 'Change the strictness of the comparisons. Can be changed to less strict (1). [default = 0](more-strict).', type = int)
 
 
 	"""Arguments for organizing data"""
@@ -72,25 +84,200 @@ def get_args():
 
 	"""Arguments for other types of analyses"""
 	parser.add_argument('-pc', '--clade', action = "store_true", dest = "clade", help = 'Plot Lefse Cladogram for each output time point. Outputs are placed in a new folder created in the lefse results location.', default = False)
-	parser.add_argument('-it', '--image', action = "store", dest = "image", type=str, help = 'Set the file type for the image create when using cladogram setting', default = 'pdf', choices=["png", "pdf", "svg"])
-	parser.add_argument('-dp', '--dpi', action = "store", dest = "dpi", type=int, help = 'Set DPI resolution for cladogram', default = 300)
+	parser.add_argument('-it', '--image', action = "store", dest = "image", type=str, nargs = '+', help = 'Set the file type(s) for the image create when using cladogram setting. Several types are saved from one drawing of each cladogram.', default = ['pdf'], choices=["png", "pdf", "svg"])
+	parser.add_argument('-dp', '--dpi', action = "store", dest = "dpi", type=int, nargs = '+', help = 'Set DPI resolution(s) for cladogram', default = [300])
+	parser.add_argument('-sl', '--shared_layout', action = "store_true", dest = "shared_layout", help = 'Plot the cladograms of all timepoints on one layout, the union of their taxonomy trees, so that the clades line up across timepoints. Used with --clade.', default = False)
+	parser.add_argument('-j', '--jobs', action = "store", dest = "jobs", type=int, help = 'Number of timepoints to analyze in parallel. [default = 1]', default = 1)
+	parser.add_argument('-ma', '--mmap', action = "store_true", dest = "mmap", help = 'Write the formatted tables (format_lefse/) as memory-mappable array containers instead of pickles. The Galaxy LEfSe application cannot read them.', default = False)
+	parser.add_argument('-cd', '--cache_dir', action = "store", dest = "cache_dir", type=str, help = 'Folder where the results of each step are cached, so that an interrupted or repeated run only recomputes the steps whose inputs or parameters changed. [default = <output>/.koeken_cache]', default = None)
+	parser.add_argument('-cs', '--cache_size', action = "store", dest = "cache_size", type=int, help = 'Maximum size of the cache in MB. The least recently used results are removed at the end of each run. [default = 1024]', default = 1024)
+	parser.add_argument('--no-cache', action = "store_true", dest = "no_cache", help = 'Recompute every step without reading or writing the cache.', default = False)
 	parser.add_argument('-pi', '--picrust', action = "store_true", dest = "picrust", help = 'Run analysis with PICRUSt biom file. Must use the cateogirze by function level 3. Next updates will reflect the difference levels.', default = False)
 
 	return parser.parse_args()
 
 
+def parse_levels(level):
+	"""Taxonomy levels from the --level values"""
+	if 'all' in level:
+		return range(2, 8)
+	return sorted(set(int(l) for l in level))
+
+
+def load_abundances(input_biom, map_df, level, picrust):
+	"""Collapse the BIOM table to relative abundances at the given taxonomy
+	(or KEGG pathway) level, as QIIME's summarize_taxa.py. Returns the mapping
+	file rows found in the table and the taxa by sample abundances in the
+	same sample order."""
+	table = biom_table.read_biom(input_biom)
+	md_identifier = 'KEGG_Pathways' if picrust else 'taxonomy'
+	taxa, counts = biom_table.collapse_taxonomy(table, level, md_identifier, '|')
+	abundance = biom_table.relative_abundance(counts)
+
+	"""Keep the samples found in both, in mapping file order"""
+	sample_pos = dict((s, i) for i, s in enumerate(table['sample_ids']))
+	sample_ids = map_df[map_df.columns[0]].astype(str)
+	found = sample_ids.isin(sample_pos).values
+	abundance = abundance[:, [sample_pos[s] for s in sample_ids[found]]]
+	return map_df[found].reset_index(drop = True), taxa, abundance
+
+
+def summarize_taxa(map_df, taxa, abundance, level, finest):
+	"""Join the abundances of one level to the mapping file, as QIIME's
+	summarize_taxa.py -m does. Coarser levels are summed from the finest one."""
+	if level < finest:
+		taxa, abundance = biom_table.aggregate_taxa(taxa, abundance, level, '|')
+	return pd.concat([map_df, pd.DataFrame(abundance.T.toarray(), columns = taxa)], axis = 1)
+
+
+def make_input_table(group, to_keep):
+	"""LEfSe input table of one timepoint: features as rows, without the empty ones"""
+	table = group.iloc[:,to_keep].transpose()
+	return table.loc[~(table==0).all(axis=1)]
+
+
+def test_features(feats, formatted, params, multiclass_strats):
+	"""KW and Wilcoxon steps of run_lefse.py at the largest p-value cutoff,
+	for every strictness. Smaller cutoffs only filter their results."""
+	return run_lefse.test_features_raw(feats, formatted['cls'], formatted['subclass_sl'], formatted['class_hierarchy'], params, multiclass_strats)
+
+
+def rank_features(feats, formatted, kept, params):
+	"""Effect size step of run_lefse.py on the features passing the tests"""
+	lefse.init(params['engine'])
+	return run_lefse.rank_features(feats.subset(kept), formatted['cls'], formatted['class_sl'], params)
+
+
+def plot_clade(run, plot_params):
+	"""Cladogram step as plot_cladogram.py. Returns the content of every image,
+	in the order of plot_cladogram.output_files."""
+	images = []
+	for image_file in plot_cladogram.draw_tree(run['clade_file_out'], plot_cladogram.read_data(run['run_file_out'], plot_params), plot_params):
+		with open(image_file, 'rb') as inp:
+			images.append(inp.read())
+	return images
+
+def plot_clades(runs, plot_params):
+	"""Cladograms of several timepoints on one shared layout as plot_cladogram.py --batch.
+	Returns the content of every image, in the order of the runs and of plot_cladogram.output_files."""
+	images = []
+	batch = plot_cladogram.read_batch([run['run_file_out'] for run in runs], plot_params)
+	for image_file in plot_cladogram.draw_batch([run['clade_file_out'] for run in runs], batch, plot_params, [run['title'] for run in runs]):
+		with open(image_file, 'rb') as inp:
+			images.append(inp.read())
+	return images
+
+
+def run_timepoint(task):
+	"""Run the LEfSe formatting, analysis and cladogram steps on one timepoint
+	within this process. Log lines and console output are returned instead of
+	written, so that parallel timepoints do not interleave them. Each step is
+	taken from the cache when its inputs and parameters did not change."""
+	name = task['name']
+	log = []
+	cache = stage_cache.StageCache(task['cache_dir'], task['cache_size'])
+	stdout = sys.stdout
+	sys.stdout = out = StringIO.StringIO()
+	try:
+		"""Format the input table as LEfSe's format_input.py"""
+		log.append('Timepoint ' + str(name))
+		log.append('Formatting Table...')
+		log.append('Formatting Input: ' + task['table_out'])
+		log.append('Formatting Output: ' + task['format_file_out'])
+
+		format_args = [task['table_out'], task['format_file_out'], '-u', '1', '-c', '2', '-o', '1000000', '-f', 'r']
+		if task['subclassid'] != "NA":
+			format_args += ['-s', '3']
+		format_key = stage_cache.stage_key(task['input_key'], 'format_table', format_args[2:])
+		if task['mmap'] == False:
+			format_args += ['--pickle']
+		format_params = format_input.read_params(format_args)
+		formatted, cached = cache.fetch(format_key, format_input.format_data, task['data'], format_params)
+		if cached:
+			log.append('Formatting: using cached result')
+		format_input.save_data(formatted, format_params)
+
+		"""Run the LEfSe analysis as LEfSe's run_lefse.py. The statistical tests
+		are run once for all the cutoff combinations, which only filter them."""
+		log.append('Running Analysis...')
+		log.append('Analysis Input: ' + task['format_file_out'])
+		runs = task['runs']
+		run_params = run_lefse.read_params([task['format_file_out'], runs[0]['run_file_out'], '-a', str(max(run['p_cutoff'] for run in runs))])
+		strats = sorted(set(run['strictness'] for run in runs))
+		feats = formatted['feats']
+		kord, cls_means = lefse.get_class_means(formatted['class_sl'], feats)
+
+		tests_key = stage_cache.stage_key(format_key, 'tests', [run_params[k] for k in TEST_PARAMS], strats)
+		(kw_pvs, wilc_ok), cached = cache.fetch(tests_key, test_features, feats, formatted, run_params, strats)
+		if cached:
+			log.append('Statistical tests: using cached result')
+
+		ranked = {}
+		for run in runs:
+			if len(runs) > 1:
+				print "Cutoffs: p-value", run['p_cutoff'], "effect", run['lda_cutoff'], "strict", run['strictness']
+			params = dict(run_params, anova_alpha = run['p_cutoff'], lda_abs_th = run['lda_cutoff'], multiclass_strat = run['strictness'])
+			wilcoxon_res, kw_n_ok, kept = run_lefse.select_features(kw_pvs, wilc_ok[params['multiclass_strat']], params)
+			run_lefse.report_tests(len(kept), kw_n_ok)
+
+			"""Effect sizes only depend on the features passing the tests, not on the cutoffs"""
+			rank_key = stage_cache.stage_key(format_key, 'rank', kept, [run_params[k] for k in RANK_PARAMS], params['lda_abs_th'] < 0.0)
+			if rank_key not in ranked:
+				ranked[rank_key], cached = cache.fetch(rank_key, rank_features, feats, formatted, kept, params)
+				if cached:
+					log.append('Effect sizes: using cached result')
+			lda_res = ranked[rank_key]
+			outres = {'lda_res_th': run_lefse.threshold_features(lda_res, params), 'lda_res': lda_res,
+				'cls_means': cls_means, 'cls_means_kord': kord, 'wilcox_res': wilcoxon_res}
+			log.append('Analysis Output: ' + run['run_file_out'])
+			lefse.save_res(outres, run['run_file_out'])
+
+			"""Check to see if cladogram option was chosen"""
+			if task['clade'] == True:
+				"""Plot the cladogram as LEfSe's plot_cladogram.py"""
+				log.append('Plotting Cladogram...')
+				log.append('Plot Input: ' + run['run_file_out'])
+				plot_args = [run['run_file_out'], run['clade_file_out'], '--format'] + task['image'] + ['--dpi'] + [str(d) for d in task['dpi']] + ['--title', run['title']]
+				plot_params = plot_cladogram.read_params(plot_args)
+				image_files = [o[0] for o in plot_cladogram.output_files(run['clade_file_out'], plot_params)]
+				for image_file in image_files:
+					log.append('Plot Output: ' + image_file)
+				clade_key = stage_cache.stage_key(task['root_key'], 'clade_images', stage_cache.file_digest(run['run_file_out']), plot_args[2:])
+				images, cached = cache.fetch(clade_key, plot_clade, run, plot_params)
+				if cached:
+					log.append('Cladogram: using cached result')
+					for image_file, image_data in zip(image_files, images):
+						with open(image_file, 'wb') as image_out:
+							image_out.write(image_data)
+	finally:
+		sys.stdout = stdout
+
+	return log, out.getvalue()
+
+
+def table_data(table, nmeta):
+	"""LEfSe input table split as format_input.read_table reads it from file:
+	the nmeta metadata rows as strings, abundance rows as one float array"""
+	return {'names': [str(row_name) for row_name in table.index[nmeta:]],
+		'meta': dict([(i, [str(v) for v in table.values[i]]) for i in range(nmeta)]),
+		'values': table.values[nmeta:].astype(float)}
+
+
 def main(args):
 
 	""" Koeken Arguments """
 	input_biom = args.input_biom
 	output_dir = args.outputDir
 	map_fp = args.map_fp
-	level = args.level
+	levels = [3] if args.picrust else parse_levels(args.level)
 	classid = args.classid
 	subclassid = args.subclassid
 	subjectid = args.subjectid
 	compare = args.compare
 	split = args.split
+	jobs = args.jobs
+	cache_dir = None if args.no_cache else (args.cache_dir or os.path.join(output_dir, '.koeken_cache'))
+	cache_size = args.cache_size * 1024 * 1024
 
 	""" LEfSe options """
 	p_cutoff = args.p_cutoff
@@ -101,11 +288,12 @@ def main(args):
 	clade = args.clade
 	image = args.image
 	dpi = args.dpi
+	shared_layout = clade and args.shared_layout
 
 	"""Check to see if output directories exist or not and create them."""
 	if not os.path.exists(output_dir):
 		os.makedirs(output_dir)
-	else:
+	elif cache_dir is None:
 		logging.warning('Output folder already exists. Warning: Errors may be produced. Please delete or change output folder before running again!.'+ '\n')
 
 	""" Start Logging """
@@ -120,19 +308,17 @@ def main(args):
 	logging.info('Output Folder: ' + output_dir)
 	logging.info('Class: ' + classid)
 	logging.info('Splitting table by: ' + split)
-	logging.info('Level: ' + str(level))
+	logging.info('Level: ' + ', '.join(str(l) for l in levels))
 	logging.info('Comparing: ' + str(compare))
-	logging.info('P-value cutoff: ' + str(p_cutoff))
-	logging.info('Effect Size Cutoff: ' + str(lda_cutoff))
+	logging.info('P-value cutoff: ' + ', '.join(str(p) for p in p_cutoff))
+	logging.info('Effect Size Cutoff: ' + ', '.join(str(e) for e in lda_cutoff))
+	logging.info('Strictness: ' + ', '.join(str(s) for s in strictness))
 	logging.info('Plot Cladogram: ' + str(clade))
-	logging.info('Image Type: ' + str(image))
+	logging.info('Image Type: ' + ', '.join(image))
+	logging.info('Shared Layout: ' + str(shared_layout))
 	logging.info('PICRUSt: ' + str(args.picrust))
-
-	"""Output location from summarize_taxa.py step"""
-	sumtaxa_dir = '{}/{}{}/'.format(output_dir, "summarize_taxa_L", str(level))
-	if not os.path.exists(sumtaxa_dir):
-		os.makedirs(sumtaxa_dir)
-		logging.info('Made directory: ' + sumtaxa_dir)
+	logging.info('Jobs: ' + str(jobs))
+	logging.info('Cache: ' + str(cache_dir))
 
 	"""Output location for all LEfSe analyses"""
 	lefse_dir = '{}/{}'.format(output_dir, "lefse_output")
@@ -159,90 +345,136 @@ def main(args):
 			os.makedirs(clado_dir)
 			logging.info('Made directory: ' + clado_dir)
 
-	"""Run summarize_taxa.py command"""
-	print "Running QIIME's summarize_taxa.py... "+ '\n'
-	if args.picrust:
-		summarize_cmd = "summarize_taxa.py -i %s -o %s -m %s -L 3 -d '|' --md_identifier 'KEGG_Pathways' " % (input_biom, sumtaxa_dir, map_fp)
-	else:
-		summarize_cmd = "summarize_taxa.py -i %s -o %s -m %s -L %d -d '|'" % (input_biom, sumtaxa_dir, map_fp, level)
-
-	subprocess.call(shlex.split(summarize_cmd))
-
-	"""Get filename of generated summarize_taxa.py outputs"""
-	if args.picrust:
-		sumtaxa_loc = glob.glob(sumtaxa_dir + '*_L3' +'.txt')
-	else:
-		sumtaxa_loc = glob.glob(sumtaxa_dir + '/*_L'+ str(level) +'.txt')
-
-	"""Create panda dataframes from summarize_taxa output file and mapping file"""
-	sumtaxa_df = pd.read_table(sumtaxa_loc[0])
+	"""Load the BIOM table once, collapsed at the finest level analyzed"""
+	print "Summarizing taxa... "+ '\n'
+	cache = stage_cache.StageCache(cache_dir, cache_size)
+	root_key = stage_cache.stage_key('koeken', __version__)
+	collapse_key = stage_cache.stage_key(root_key, 'collapse', stage_cache.file_digest(input_biom), stage_cache.file_digest(map_fp), max(levels), args.picrust)
 	map_df = pd.read_table(map_fp)
+	(map_df, taxa, abundance), cached = cache.fetch(collapse_key, load_abundances, input_biom, map_df, max(levels), args.picrust)
+	if cached:
+		logging.info('Summarized taxa: using cached result')
 
 	"""Find the cols and respective positions for input variables on the table."""
 	""" Row 1 = Subject"""
 	""" Row 2 = Class"""
 	""" Row 3 = Subclass/None"""
 	""" Row 4-: = Bacteria"""
-	subjectID_pos = sumtaxa_df.columns.get_loc(subjectid)
-	classID_pos = sumtaxa_df.columns.get_loc(classid)
-	bacteria_pos = range((len(map_df.columns)),len(sumtaxa_df.columns)) # Find the number of cols in mapping file
+	subjectID_pos = map_df.columns.get_loc(subjectid)
+	classID_pos = map_df.columns.get_loc(classid)
 
 	"""Cases for addition of subject class"""
 	if subclassid == "NA":
-		to_keep = [subjectID_pos,classID_pos] + bacteria_pos
+		meta_keep = [subjectID_pos,classID_pos]
 	else:
-		subclassID_pos = sumtaxa_df.columns.get_loc(subclassid)
-		to_keep = [subjectID_pos, classID_pos, subclassID_pos] + bacteria_pos
+		subclassID_pos = map_df.columns.get_loc(subclassid)
+		meta_keep = [subjectID_pos, classID_pos, subclassID_pos]
 
 	"""Subset the data if particular group comparisons are given"""
+	samples_kept = np.ones(len(map_df), dtype = bool)
 	if compare != "":
-		sumtaxa_df = sumtaxa_df[sumtaxa_df[classid].isin(compare)]
-
-	""" Remove greengenes taxa names to makeit prettier """
-	sumtaxa_df = sumtaxa_df.rename(columns = lambda x: re.sub('.__', '', x))
-	sumtaxa_df = sumtaxa_df.rename(columns = lambda x: re.sub(' ', '_', x))
-
-	"""For each timepoint, remove unwanted columns and perform LEfSe analysis"""
-	grouped_df = sumtaxa_df.groupby(str(split))
-	for name, group in grouped_df:
-
-		"""Write Input tables to file"""
-		table = group.iloc[:,to_keep].transpose()
-		table_filtered = table.loc[~(table==0).all(axis=1)]
-		table_out = '{}{}{}'.format(sumtaxa_dir, name, '_input.txt')
-		table_filtered.to_csv(table_out, sep = '\t', header = False, index = True)
-
-		"""Run format_input.py from LEfSe package"""
-		format_file_out = format_dir + os.path.basename(table_out).replace('_input.txt', '_format.txt')
-		logging.info('Timepoint ' + str(name))
-		logging.info('Formatting Table...')
-		logging.info('Formatting Input: ' + table_out)
-		logging.info('Formatting Output: ' + format_file_out)
-
-		if subclassid == "NA":
-			subprocess.call(['format_input.py', table_out, format_file_out, '-u 1', '-c 2', '-o 1000000', '-f', 'r'])
-		else:
-			subprocess.call(['format_input.py', table_out, format_file_out, '-u 1', '-c 2', '-s 3', '-o 1000000', '-f', 'r'])
-
-		"""Run run_lefse.py from LEfSe package"""
-		run_file_out = run_dir + os.path.basename(format_file_out).replace('_format.txt', '.txt')
-		logging.info('Running Analysis...')
-		logging.info('Analysis Input: ' + format_file_out)
-		logging.info('Analysis Output: ' + run_file_out)
-		subprocess.call(['run_lefse.py', format_file_out, run_file_out, '-a', str(p_cutoff), '-l', str(lda_cutoff), '-y', str(strictness)])
-
-		"""Check to see if cladogram option was chosen"""
-		if clade == True:
-			"""Run plot_cladogram.py from LEfSe package"""
-			clade_file_out = clado_dir + os.path.basename(format_file_out).replace('_format.txt', '.' + image)
-			logging.info('Plotting Cladogram...')
-			logging.info('Plot Input: ' + run_file_out)
-			logging.info('Plot Output: ' + clade_file_out)
-
-			subprocess.call(['plot_cladogram.py', run_file_out, clade_file_out, '--format', image, '--dpi', str(dpi), '--title', str(name)])
-
-		''' Formatting '''
+		samples_kept = map_df[classid].isin(compare).values
+
+	"""Every combination of the cutoffs is analyzed from the same statistical tests"""
+	cutoffs = sorted(set((p, e, s) for p in p_cutoff for e in lda_cutoff for s in strictness))
+
+	"""Split the samples by timepoint once for all levels"""
+	timepoints = sorted(map_df[samples_kept].groupby(str(split)).indices.items())
+
+	tasks = []
+	for level in levels:
+
+		"""Output location for the summarized table of this level"""
+		sumtaxa_dir = '{}/{}{}/'.format(output_dir, "summarize_taxa_L", str(level))
+		if not os.path.exists(sumtaxa_dir):
+			os.makedirs(sumtaxa_dir)
+			logging.info('Made directory: ' + sumtaxa_dir)
+
+		"""Write the summarized table to file"""
+		sumtaxa_df = summarize_taxa(map_df, taxa, abundance, level, max(levels))
+		sumtaxa_loc = '{}{}_L{}.txt'.format(sumtaxa_dir, os.path.splitext(os.path.basename(map_fp))[0], level)
+		sumtaxa_df.to_csv(sumtaxa_loc, sep = '\t', header = True, index = False)
+		logging.info('Summarized table: ' + sumtaxa_loc)
+
+		bacteria_pos = range((len(map_df.columns)),len(sumtaxa_df.columns)) # Find the number of cols in mapping file
+		to_keep = meta_keep + bacteria_pos
+		sumtaxa_df = sumtaxa_df[samples_kept]
+
+		""" Remove greengenes taxa names to makeit prettier """
+		sumtaxa_df = sumtaxa_df.rename(columns = lambda x: re.sub('.__', '', x))
+		sumtaxa_df = sumtaxa_df.rename(columns = lambda x: re.sub(' ', '_', x))
+
+		"""For each timepoint, remove unwanted columns and write the LEfSe input table"""
+		for name, rows in timepoints:
+			"""Write Input tables to file"""
+			input_key = stage_cache.stage_key(collapse_key, 'input', level, name, to_keep, split, compare)
+			table_filtered, cached = cache.fetch(input_key, make_input_table, sumtaxa_df.iloc[rows], to_keep)
+			table_out = '{}{}{}'.format(sumtaxa_dir, name, '_input.txt')
+			table_filtered.to_csv(table_out, sep = '\t', header = False, index = True)
+
+			"""Outputs of several levels share the LEfSe folders, so their names get the level"""
+			out_name = str(name) if len(levels) == 1 else '{}_L{}'.format(name, level)
+			runs = []
+			for p, e, s in cutoffs:
+				run_name = out_name if len(cutoffs) == 1 else '{}_p{}_e{}_str{}'.format(out_name, p, e, s)
+				run = {'p_cutoff': p, 'lda_cutoff': e, 'strictness': s, 'title': run_name, 'run_file_out': run_dir + run_name + '.txt', 'layout': (level, p, e, s)}
+				if clade == True:
+					run['clade_file_out'] = clado_dir + run_name + '.' + image[0]
+				runs.append(run)
+			task = {'name': out_name, 'size': table_filtered.size, 'data': table_data(table_filtered, len(meta_keep)), 'table_out': table_out,
+				'format_file_out': format_dir + out_name + '_format.txt', 'runs': runs,
+				'subclassid': subclassid, 'mmap': args.mmap, 'clade': clade and not shared_layout, 'image': image, 'dpi': dpi,
+				'root_key': root_key, 'input_key': input_key, 'cache_dir': cache_dir, 'cache_size': cache_size}
+			tasks.append(task)
+
+	"""Perform LEfSe analysis on each level and timepoint, largest tables first when running in parallel"""
+	if jobs > 1:
+		pool = multiprocessing.Pool(processes = max(1, min(jobs, len(tasks))))
+		pending = {}
+		for i in sorted(range(len(tasks)), key = lambda i: -tasks[i]['size']):
+			pending[i] = pool.apply_async(run_timepoint, (tasks[i],))
+		pool.close()
+		results = (pending[i].get() for i in range(len(tasks)))
+	else:
+		results = (run_timepoint(task) for task in tasks)
+
+	"""Write logs and outputs in level and timepoint order, whatever order they completed in"""
+	for log, out in results:
+		for line in log:
+			logging.info(line)
+		sys.stdout.write(out)
 		print('\n')
+	if jobs > 1:
+		pool.join()
+
+	"""Plot the cladograms of every level and cutoffs on the layout shared by its timepoints"""
+	if shared_layout:
+		layouts, order = {}, []
+		for task in tasks:
+			for run in task['runs']:
+				if run['layout'] not in layouts:
+					layouts[run['layout']] = []
+					order.append(run['layout'])
+				layouts[run['layout']].append(run)
+		for layout in order:
+			runs = layouts[layout]
+			logging.info('Plotting Cladograms on a shared layout...')
+			plot_args = ['--format'] + image + ['--dpi'] + [str(d) for d in dpi]
+			plot_params = plot_cladogram.read_params([run_dir, clado_dir, '--batch'] + plot_args)
+			image_files = [o[0] for run in runs for o in plot_cladogram.output_files(run['clade_file_out'], plot_params)]
+			for run in runs:
+				logging.info('Plot Input: ' + run['run_file_out'])
+			for image_file in image_files:
+				logging.info('Plot Output: ' + image_file)
+			batch_key = stage_cache.stage_key(root_key, 'clade_batch', [stage_cache.file_digest(run['run_file_out']) for run in runs], [run['title'] for run in runs], plot_args)
+			images, cached = cache.fetch(batch_key, plot_clades, runs, plot_params)
+			if cached:
+				logging.info('Cladograms: using cached result')
+				for image_file, image_data in zip(image_files, images):
+					with open(image_file, 'wb') as image_out:
+						image_out.write(image_data)
+
+	cache.evict()
 
 	''' Print finished analysis '''
 	logging.info('Analysis Completed.')
@@ -269,6 +501,9 @@ if __name__ == '__main__':
 	if str(args.split) not in map_chk.columns.values.tolist():
 		raise ValueError('Warning. There is no split variable with that column name in your mapping file. Please verify the subclass ID chosen is actually a column name in your mapping file.')
 
+	if args.jobs < 1:
+		raise ValueError('Warning. The number of jobs must be at least 1.')
+
 	if(args.compare) != "":
 		if (len(args.compare) == 1):
 			raise ValueError("Warning. Comparison needs to be in the format of Group1 Group2. Do not use any separators.")
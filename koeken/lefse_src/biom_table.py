@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+	biom_table.py
+	~~~~~~~~~
+	Reads BIOM tables (JSON 1.0 and HDF5 2.1) into sparse matrices and
+	collapses their observations by taxonomy, as QIIME's summarize_taxa.py.
+"""
+
+import json
+import numpy
+from scipy import sparse
+
+HDF5_MAGIC = '\x89HDF\r\n\x1a\n'
+
+
+def read_biom(biom_fp):
+	"""Loads a BIOM table. Returns a dict with the observation and sample ids,
+	their metadata (one dict or None per id) and the observation by sample
+	counts as a scipy CSR matrix."""
+	with open(biom_fp, 'rb') as inp:
+		magic = inp.read(len(HDF5_MAGIC))
+	if magic == HDF5_MAGIC:
+		return read_biom_hdf5(biom_fp)
+	return read_biom_json(biom_fp)
+
+
+def read_biom_json(biom_fp):
+	"""Loads a JSON (version 1.0) BIOM table"""
+	with open(biom_fp) as inp:
+		biom = json.load(inp)
+	shape = tuple(biom['shape'])
+	if biom['matrix_type'] == 'sparse':
+		data = numpy.array(biom['data'], dtype=float).reshape(-1, 3)
+		counts = sparse.csr_matrix((data[:,2], (data[:,0].astype(int), data[:,1].astype(int))), shape = shape)
+	else:
+		counts = sparse.csr_matrix(numpy.array(biom['data'], dtype=float).reshape(shape))
+	return {'observation_ids': [str(r['id']) for r in biom['rows']],
+		'observation_metadata': [r.get('metadata') for r in biom['rows']],
+		'sample_ids': [str(c['id']) for c in biom['columns']],
+		'sample_metadata': [c.get('metadata') for c in biom['columns']],
+		'data': counts}
+
+
+def read_biom_hdf5(biom_fp):
+	"""Loads an HDF5 (version 2.1) BIOM table"""
+	try:
+		import h5py
+	except ImportError:
+		raise ImportError('The module """h5py"" was not found! '
+		'Please install with """pip install h5py""" to read HDF5 BIOM tables')
+
+	def ids(grp):
+		return [str(i) for i in grp['ids'][:]]
+
+	def metadata(grp, n):
+		md = [{} for i in range(n)]
+		if 'metadata' not in grp:
+			return [None] * n
+		for cat, values in grp['metadata'].items():
+			for i, v in enumerate(values[:]):
+				md[i][cat] = [str(vv) for vv in v if str(vv)] if numpy.ndim(v) else str(v)
+		return [m if m else None for m in md]
+
+	with h5py.File(biom_fp, 'r') as biom:
+		obs, smp = biom['observation'], biom['sample']
+		obs_ids, smp_ids = ids(obs), ids(smp)
+		counts = sparse.csr_matrix((obs['matrix/data'][:], obs['matrix/indices'][:], obs['matrix/indptr'][:]),
+			shape = (len(obs_ids), len(smp_ids)), dtype=float)
+		return {'observation_ids': obs_ids,
+			'observation_metadata': metadata(obs, len(obs_ids)),
+			'sample_ids': smp_ids,
+			'sample_metadata': metadata(smp, len(smp_ids)),
+			'data': counts}
+
+
+def get_lineage(md, md_identifier):
+	"""Lineage of an observation as a list of ranks"""
+	if not md or md.get(md_identifier) is None:
+		return ['Unassigned']
+	lineage = md[md_identifier]
+	if isinstance(lineage, basestring):
+		lineage = lineage.split(';')
+	elif len(lineage) and not isinstance(lineage[0], basestring):
+		lineage = lineage[0]
+	return [str(v).strip() for v in lineage]
+
+
+def collapse_taxonomy(table, level, md_identifier = 'taxonomy', delimiter = ';'):
+	"""Sums the observations sharing their first level ranks, shorter lineages
+	being padded with 'Other' as summarize_taxa.py. Returns the collapsed names
+	and the taxa by sample counts."""
+	names = []
+	for md in table['observation_metadata']:
+		lineage = get_lineage(md, md_identifier)[:level]
+		names.append(delimiter.join(lineage + ['Other'] * (level - len(lineage))))
+	return sum_by_name(names, table['data'])
+
+
+def aggregate_taxa(taxa, counts, level, delimiter = ';'):
+	"""Sums taxa collapsed by collapse_taxonomy up to a coarser level"""
+	return sum_by_name([delimiter.join(t.split(delimiter)[:level]) for t in taxa], counts)
+
+
+def sum_by_name(names, counts):
+	"""Sums the rows of counts sharing the same name with one sparse product.
+	Returns the sorted distinct names and their summed counts."""
+	uniq, codes = numpy.unique(names, return_inverse=True)
+	n = len(codes)
+	indicator = sparse.csr_matrix((numpy.ones(n), (codes, numpy.arange(n))), shape = (len(uniq), n))
+	return list(uniq), indicator.dot(counts)
+
+
+def relative_abundance(counts):
+	"""Scales every sample (column) of counts to sum to 1"""
+	totals = numpy.asarray(counts.sum(axis=0)).ravel()
+	totals[totals == 0] = 1.0
+	return sparse.csr_matrix(counts.multiply(1.0 / totals[None,:]))
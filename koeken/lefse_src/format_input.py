@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
-import sys,os,argparse,pickle,re,numpy
+import sys,os,argparse,pickle,re,string,numpy
+from scipy import sparse
+from lefse import save_data_array,FeatureTable
+import biom_table
 
 
 
@@ -25,13 +28,8 @@ import sys,os,argparse,pickle,re,numpy
 #*   The syntax or logic for the original non-biom case was NOT changed.                                       *
 #*                                                                                                             *
 #*   <*******************  IMPORTANT NOTE   *************************>                                         *
-#*   The biom case requires breadcrumbs and therefore there is a                                               *
-#*      a conditional import of the breadcrumbs modules                                                        *
-#*   If the User uses a biom input and breadcrumbs is not detected,                                            *
-#*       the run is abnormally ended                                                                           *
-#*   breadcrumbs itself needs a biom environment, so if the immport                                            *
-#*       of biom in breadcrumbs fails,  the run is also abnormally 
-#*       ended (Only if the input file was biom)                                                               *
+#*   biom files are now read natively by biom_table.py (JSON 1.0 and HDF5 2.1, the latter                     *
+#*       requiring h5py): breadcrumbs is no longer needed                                                      *
 #*                                                                                                             *
 #*   USAGE EXAMPLES                                                                                            *
 #*   --------------                                                                                            *
@@ -44,16 +42,59 @@ import sys,os,argparse,pickle,re,numpy
 #*                                                                                                             *
 #***************************************************************************************************************         
 
-def read_input_file(inp_file, CommonArea):
+def read_input_file(inp_file, CommonArea, meta_rows = None):
 
 	if inp_file.endswith('.biom'):   			#*  If the file format is biom: 
 		CommonArea = biom_processing(inp_file)  #*  Process in biom format 
 		return CommonArea 						#*  And return the CommonArea
 
+	if not meta_rows is None:
+		CommonArea['ReturnedData'] = read_table(inp_file, meta_rows)
+		return CommonArea
+
 	with open(inp_file) as inp:
 		CommonArea['ReturnedData'] = [[v.strip() for v in line.strip().split("\t")] for line in inp.readlines()]
 		return CommonArea
 
+def read_table(inp_file, meta_rows, chunk_size = 1024):
+	"""Streams a table with the features on rows. The meta_rows (class, subclass
+	and subject) are kept as strings, the other rows are parsed chunk_size at a
+	time into one preallocated float array. Rows are cut to the shortest one."""
+	with open(inp_file) as inp:
+		nrows = sum(1 for line in inp if line.strip())
+		if not nrows: return {'names': [], 'meta': {}, 'values': numpy.zeros((0,0))}
+		inp.seek(0)
+		names, meta, chunk = [], {}, []
+		values = width = ncols = None
+		n = 0
+		for line in inp:
+			fields = line.strip().split("\t")
+			if fields == ['']: continue
+			if values is None:
+				width = ncols = len(fields)
+				values = numpy.empty((nrows-len([r for r in set(meta_rows) if r < nrows]),width-1))
+			ncols = min(ncols,len(fields))
+			if len(names)+len(meta) in meta_rows: meta[len(names)+len(meta)] = [v.strip() for v in fields[1:]]
+			else:
+				names.append(fields[0].strip())
+				chunk.append(fields[1:width]+['nan']*(width-len(fields)))
+				if len(chunk) == chunk_size:
+					values[n:n+len(chunk)] = numpy.array(chunk,dtype=float)
+					n += len(chunk)
+					chunk = []
+		if chunk: values[n:n+len(chunk)] = numpy.array(chunk,dtype=float)
+	return {'names': names,
+		'meta': dict([(r,v[:ncols-1]) for r,v in meta.items()]),
+		'values': values[:,:ncols-1]}
+
+def table_from_rows(data, meta_rows):
+	"""Splits the rows of an input table as read_table does"""
+	ncols = min([len(r) for r in data])
+	rows = [i for i in range(len(data)) if not i in meta_rows]
+	return {'names': [data[i][0] for i in rows],
+		'meta': dict([(i,list(data[i][1:ncols])) for i in meta_rows if i < len(data)]),
+		'values': numpy.array([data[i][1:ncols] for i in rows],dtype=float).reshape(len(rows),ncols-1)}
+
 def transpose(data):
 	return zip(*data)
 
@@ -78,15 +119,22 @@ def read_params(args):
 		help="set the policy to adopt with missin values: f removes the features with missing values, s removes samples with missing values (default f)")
 	parser.add_argument('-n',dest="subcl_min_card", metavar="int", type=int, default=10,
 		help="set the minimum cardinality of each subclass (subclasses with low cardinalities will be grouped together, if the cardinality is still low, no pairwise comparison will be performed with them)")
+	parser.add_argument('--pickle',dest="pickle", action='store_true', default=False,
+		help="write the output as a pickle, as LEfSe 1.0 and its Galaxy module read it, instead of a memory-mappable array container")
 
 	parser.add_argument('-biom_c',dest="biom_class", type=str, 
 		help="For biom input files: Set which feature use as class  ")		
 	parser.add_argument('-biom_s',dest="biom_subclass", type=str, 
 		help="For biom input files: set which feature use as subclass   ")
 	
-	args = parser.parse_args()
-	
-	return vars(args)	
+	args = parser.parse_args(args)
+	params = vars(args)
+
+	if type(params['subclass']) is int and int(params['subclass']) < 1:
+		params['subclass'] = None
+	if type(params['subject']) is int and int(params['subject']) < 1:
+		params['subject'] = None
+	return params
 
 def remove_missing(data,roc):
 	if roc == "c": data = transpose(data)
@@ -101,27 +149,10 @@ def remove_missing(data,roc):
 	return data
 
                                                                                                                                       
-def sort_by_cl(data,n,c,s,u):           
-	def sort_lines1(a,b): 
-        	return int(a[c] > b[c])*2-1                                                                                           
-	def sort_lines2u(a,b):        
-        	if a[c] != b[c]: return int(a[c] > b[c])*2-1                                                                  
-		return int(a[u] > b[u])*2-1
-	def sort_lines2s(a,b):        
-        	if a[c] != b[c]: return int(a[c] > b[c])*2-1                                                                  
-		return int(a[s] > b[s])*2-1
-	def sort_lines3(a,b):      
-        	if a[c] != b[c]: return int(a[c] > b[c])*2-1                                                                   
-		if a[s] != b[s]: return int(a[s] > b[s])*2-1                                                                          
-		return int(a[u] > b[u])*2-1 
-        if n == 3: data.sort(sort_lines3)                                                                                  
-        if n == 2: 
-	  if s is None: 
-	    data.sort(sort_lines2u)
-	  else:
-	    data.sort(sort_lines2s)
-        if n == 1: data.sort(sort_lines1)                                                                                  
-	return data  
+def sort_by_cl(labels):
+	"""Stable lexsort permutation of the samples by their labels, the first
+	label (class) taking precedence over the next ones (subclass or subject)"""
+	return numpy.lexsort([numpy.array(l) for l in reversed(labels)])
 
 def group_small_subclasses(cls,min_subcl):
 	last = ""
@@ -141,57 +172,50 @@ def group_small_subclasses(cls,min_subcl):
 	cls['subclass'] = dd[1]
 	return cls		
 
-def get_class_slices(data):
-        previous_class = data[0][0]
-        previous_subclass = data[0][1]
-        subclass_slices = []
-        class_slices = []
-        last_cl = 0     
-        last_subcl = 0                                                                                                                 
-        class_hierarchy = []
-        subcls = []                                                                                                                    
-        for i,d in enumerate(data):
-                if d[1] != previous_subclass:                                                                                          
-                        subclass_slices.append((previous_subclass,(last_subcl,i)))
-                        last_subcl = i                                                                                                 
-                        subcls.append(previous_subclass)                                                                               
-                if d[0] != previous_class:                                                                                             
-                        class_slices.append((previous_class,(last_cl,i)))                                                              
-                        class_hierarchy.append((previous_class,subcls))                                                                
-                        subcls = [] 
-                        last_cl = i     
-                previous_subclass = d[1]
-                previous_class = d[0]
-        subclass_slices.append((previous_subclass,(last_subcl,i+1)))
-        subcls.append(previous_subclass)
-        class_slices.append((previous_class,(last_cl,i+1)))                                                                            
-        class_hierarchy.append((previous_class,subcls))
-        return dict(class_slices), dict(subclass_slices), dict(class_hierarchy)
-
-def numerical_values(feats,norm):
-	mm = []
-	for k,v in feats.items():
-		feats[k] = [float(val) for val in v]
-	if norm < 0.0: return feats
-	tr = zip(*(feats.values()))
-	mul = []
-	fk = feats.keys()
-	hie = True if sum([k.count(".") for k in fk]) > len(fk) else False
-	for i in range(len(feats.values()[0])):
-		if hie: mul.append(sum([t for j,t in enumerate(tr[i]) if fk[j].count(".") < 1 ]))
-		else: mul.append(sum(tr[i]))
-	if hie and sum(mul) == 0:
-		mul = []
-		for i in range(len(feats.values()[0])):
-			mul.append(sum(tr[i]))
-	for i,m in enumerate(mul):
-		if m == 0: mul[i] = 0.0
-		else: mul[i] = float(norm) / m
-	for k,v in feats.items():
-		feats[k] = [val*mul[i] for i,val in enumerate(v)]
-		if numpy.mean(feats[k]) and (numpy.std(feats[k])/numpy.mean(feats[k])) < 1e-10:
-			feats[k] = [ float(round(kv*1e6)/1e6) for kv in feats[k]]
-	return feats
+def run_starts(labels):
+	"""Start offsets of the runs of equal consecutive labels"""
+	lab = numpy.array(labels)
+	return numpy.concatenate(([0],numpy.flatnonzero(lab[1:] != lab[:-1])+1))
+
+def get_class_slices(cl,subcl):
+	"""One grouping pass over the samples sorted by class and subclass: the
+	subclasses found in several classes are renamed <class>_<subclass>, then
+	the class and subclass slices and the class hierarchy are computed from
+	the offsets where the labels change. Returns the renamed subclasses too."""
+	classes = {}
+	for c,sc in zip(cl,subcl): classes.setdefault(sc,set()).add(c)
+	subcl = [c+"_"+sc if len(classes[sc]) > 1 else sc for c,sc in zip(cl,subcl)]
+	cls_st,subcls_st = run_starts(cl),run_starts(subcl)
+	cls_end,subcls_end = numpy.append(cls_st[1:],len(cl)),numpy.append(subcls_st[1:],len(cl))
+	# subclasses of a class are the runs starting inside its slice
+	first,last = numpy.searchsorted(subcls_st,cls_st),numpy.searchsorted(subcls_st,cls_end)
+	# names are taken from the last sample of each run, as the labels shared in the pickles
+	class_slices = [(cl[e-1],(int(b),int(e))) for b,e in zip(cls_st,cls_end)]
+	subclass_slices = [(subcl[e-1],(int(b),int(e))) for b,e in zip(subcls_st,subcls_end)]
+	class_hierarchy = [(cl[e-1],[subcl[se-1] for se in subcls_end[f:l]]) for e,f,l in zip(cls_end,first,last)]
+	return subcl, dict(class_slices), dict(subclass_slices), dict(class_hierarchy)
+
+def numerical_values(names,x,norm):
+	"""Normalizes in place the feature by sample matrix x, whose rows are the
+	features names"""
+	if not len(names): return x
+	if norm >= 0.0:
+		# per sample totals: of the top level features only if the features
+		# are hierarchical (and these are not all null), of all of them otherwise
+		hie = True if sum([k.count(".") for k in names]) > len(names) else False
+		tot = x[numpy.array([k.count(".") < 1 for k in names])].sum(axis=0) if hie else x.sum(axis=0)
+		if hie and sum(tot.tolist()) == 0: tot = x.sum(axis=0)
+		with numpy.errstate(divide='ignore'):
+			x *= numpy.where(tot == 0, 0.0, float(norm)/tot)
+		# near constant features are rounded to 6 decimals, halves away from zero
+		mean = x.mean(axis=1)
+		with numpy.errstate(divide='ignore',invalid='ignore'):
+			const = (mean != 0) & (x.std(axis=1)/mean < 1e-10)
+		if const.any():
+			y = x[const]*1e6
+			a = numpy.abs(y)
+			x[const] = numpy.copysign(numpy.floor(a)+(a-numpy.floor(a) >= 0.5),y)/1e6
+	return x
 
 def add_missing_levels2(ff):
 	
@@ -223,100 +247,71 @@ def add_missing_levels2(ff):
 	return ff
 				
 				
-def add_missing_levels(ff):
-	if sum( [f.count(".") for f in ff] ) < 1: return ff
-	
-	clades2leaves = {}
-	for f in ff:
+def clade_indicator(names):
+	"""Compiles the hierarchy of the dotted feature names into a sparse clade
+	by feature indicator: every non-empty proper prefix of a feature with at
+	least one level separator is a clade containing it"""
+	clades,rows,cols = {},[],[]
+	for j,f in enumerate(names):
 		fs = f.split(".")
-		if len(fs) < 2:
-			continue
-		for l in range(len(fs)):
-			n = ".".join( fs[:l] )
-			if n in clades2leaves:
-				clades2leaves[n].append( f )
-			else:
-				clades2leaves[n] = [f]
-	for k,v in clades2leaves.items():
-		if k and k not in ff:
-			ff[k] = [sum(a) for a in zip(*[[float(fn) for fn in ff[vv]] for vv in v])]
-	return ff
+		for l in range(1,len(fs)):
+			rows.append(clades.setdefault(".".join(fs[:l]),len(clades)))
+			cols.append(j)
+	return sorted(clades,key=clades.get),sparse.csr_matrix((numpy.ones(len(rows)),(rows,cols)),shape=(len(clades),len(names)))
+
+def add_missing_levels(names,x):
+	"""Appends to the features (names, rows of x) the clades of their dotted
+	names that are not features, each summing the features it contains"""
+	if sum( [f.count(".") for f in names] ) < 1: return names,x
+	
+	clades,ind = clade_indicator(names)
+	known = set(names)
+	missing = [i for i,k in enumerate(clades) if k not in known]
+	if not missing: return names,x
+	out = numpy.empty((len(names)+len(missing),x.shape[1]))
+	out[:len(names)] = x
+	out[len(names):] = ind[missing].dot(x)
+	return list(names)+[clades[i] for i in missing],out
 
 			
 
+NAME_DELETE = ' $@#%^&*"\''
+NAME_TABLE = string.maketrans('/()-+={}[],.;:?<>|','_'*17+'.')
+LEADING_DIGIT = re.compile('^(?=[0-9])')
+# sanitized names are memoized, koeken formats the same taxa at every timepoint
+FEATURE_NAMES = {}
+
+def modify_feature_name(f):
+	ret = FEATURE_NAMES.get(f)
+	if ret is None:
+		ret = LEADING_DIGIT.sub('f_',f.translate(NAME_TABLE,NAME_DELETE),1)
+		FEATURE_NAMES[f] = ret
+	return ret
+
 def modify_feature_names(fn):
-	ret = fn
-
-	for v in [' ',r'\$',r'\@',r'#',r'%',r'\^',r'\&',r'\*',r'\"',r'\'']:
-                ret = [re.sub(v,"",f) for f in ret]
-        for v in ["/",r'\(',r'\)',r'-',r'\+',r'=',r'{',r'}',r'\[',r'\]',
-		r',',r'\.',r';',r':',r'\?',r'\<',r'\>',r'\.',r'\,']:
-                ret = [re.sub(v,"_",f) for f in ret]
-        for v in ["\|"]:
-                ret = [re.sub(v,".",f) for f in ret]
-	
-	ret2 = []
-	for r in ret:
-		if r[0] in ['0','1','2','3','4','5','6','7','8','9']:
-			ret2.append("f_"+r)
-		else: ret2.append(r)	
-				
-	return ret2 
+	return [modify_feature_name(f) for f in fn]
 		
 
-def rename_same_subcl(cl,subcl):
-	toc = []
-	for sc in set(subcl):
-		if len(set([cl[i] for i in range(len(subcl)) if sc == subcl[i]])) > 1:
-			toc.append(sc)
-	new_subcl = []
-	for i,sc in enumerate(subcl):
-		if sc in toc: new_subcl.append(cl[i]+"_"+sc)
-		else: new_subcl.append(sc)
-	return new_subcl
-	
-	
 #*************************************************************************************
 #*  Modifications by George Weingart,  Jan 15, 2014                                  *
 #*  If the input file is biom:                                                       *
-#*  a. Load an AbundanceTable (Using breadcrumbs)                                    *
-#*  b. Create a sequential file from the AbundanceTable (de-facto - pcl)             *
-#*  c. Use that file as input to the rest of the program                             *
-#*  d. Calculate the c,s,and u parameters, either from the values the User entered   *
+#*  a. Load the table (biom_table.py, the counts stay sparse until formatting)       *
+#*  b. Build the split table as read_table does: the sample ids and the sample       *
+#*     metadata as the metadata rows, the observations as the float rows            *
+#*  c. Calculate the c,s,and u parameters, either from the values the User entered   *
 #*     from the meta data values in the biom file or set up defaults                 * 
-#*  <<<-------------  I M P O R T A N T     N O T E ------------------->>            *
-#*  breadcrumbs src directory must be included in the PYTHONPATH                     *
-#*  <<<-------------  I M P O R T A N T     N O T E ------------------->>            *	
 #*************************************************************************************	
 def biom_processing(inp_file):
 	CommonArea = dict()			#* Set up a dictionary to return
-	CommonArea['abndData']   = AbundanceTable.funcMakeFromFile(inp_file,	#* Create AbundanceTable from input biom file
-		cDelimiter = None,
-		sMetadataID = None,
-		sLastMetadataRow = None,
-		sLastMetadata = None,
-		strFormat = None)
-
-	#****************************************************************
-	#*  Building the data element here                              *
-	#****************************************************************
-	ResolvedData = list()		#This is the Resolved data that will be returned
-	IDMetadataName  = CommonArea['abndData'].funcGetIDMetadataName()   #* ID Metadataname 
-	IDMetadata = [CommonArea['abndData'].funcGetIDMetadataName()]  #* The first Row
-	for IDMetadataEntry in CommonArea['abndData'].funcGetMetadataCopy()[IDMetadataName]:  #* Loop on all the metadata values
-		IDMetadata.append(IDMetadataEntry)
-	ResolvedData.append(IDMetadata)					#Add the IDMetadata with all its values to the resolved area
-	for key, value in  CommonArea['abndData'].funcGetMetadataCopy().iteritems(): 
-		if  key  != IDMetadataName:
-			MetadataEntry = list()		#*  Set it up
-			MetadataEntry.append(key)	#*	And post it to the area
-			for x in value:
-				MetadataEntry.append(x)		#* Append the metadata value name
-			ResolvedData.append(MetadataEntry)
-	for AbundanceDataEntry in    CommonArea['abndData'].funcGetAbundanceCopy(): 		#* The Abundance Data
-		lstAbundanceDataEntry = list(AbundanceDataEntry)	#Convert tuple to list
-		ResolvedData.append(lstAbundanceDataEntry)			#Append the list to the metadata list
-	CommonArea['ReturnedData'] = 	ResolvedData			#Post the results 
+	table = biom_table.read_biom(inp_file)
+	smd = [md or {} for md in table['sample_metadata']]
+	categories = sorted(set([k for md in smd for k in md]))
+	CommonArea['MetadataNames'] = ['ID'] + categories	#* The sample ids are the first metadata row
+	meta = {0: table['sample_ids']}
+	for i,cat in enumerate(categories):
+		meta[i+1] = [str(md.get(cat,'')) for md in smd]
+	CommonArea['ReturnedData'] = {'names': table['observation_ids'], 'meta': meta,
+		'values': table['data'].toarray()}
 	return CommonArea   
 
 	
@@ -324,16 +319,11 @@ def biom_processing(inp_file):
 #*    Check the params and override in the case of biom                        *
 #*******************************************************************************
 def  check_params_for_biom_case(params, CommonArea):
-	CommonArea['MetadataNames'] = list()			#Metadata  names
 	params['original_class'] = params['class']			#Save the original class
 	params['original_subclass'] = params['subclass']	#Save the original subclass	
 	params['original_subject'] = params['subject']	#Save the original subclass	
 
-
-	TotalMetadataEntriesAndIDInBiomFile = len(CommonArea['abndData'].funcGetMetadataCopy())  # The number of metadata entries
-	for i in range(0,TotalMetadataEntriesAndIDInBiomFile): 	#* Populate the meta data names table
-		CommonArea['MetadataNames'].append(CommonArea['ReturnedData'][i][0])	#Add the metadata name
-	
+	TotalMetadataEntriesAndIDInBiomFile = len(CommonArea['MetadataNames'])  # The number of metadata entries
 
 	#****************************************************
 	#* Setting the params here                          *
@@ -346,93 +336,57 @@ def  check_params_for_biom_case(params, CommonArea):
 	if TotalMetadataEntriesAndIDInBiomFile == 3:		#If there are 3:  Set up default that the second entry is the class and the third is the subclass
 		params['class'] =  2
 		params['subclass'] =  3
-		FlagError = False								#Set up error flag
-
-		if not params['biom_class'] is None and not params['biom_subclass'] is None:				#Check if the User passed a valid class and subclass
-			if  params['biom_class'] in CommonArea['MetadataNames']:
-				params['class'] =  CommonArea['MetadataNames'].index(params['biom_class']) +1	#* Set up the index for that metadata
-			else:
-				FlagError = True
-			if  params['biom_subclass'] in  CommonArea['MetadataNames']:
-				params['subclass'] =  CommonArea['MetadataNames'].index(params['biom_subclass']) +1 #* Set up the index for that metadata
-			else:
-				FlagError = True
-		if FlagError == True:		#* If the User passed an invalid class
-			print "**Invalid biom class or subclass passed - Using defaults: First metadata=class, Second Metadata=subclass\n"
-			params['class'] =  2
-			params['subclass'] =  3
+	default = (params['class'], params['subclass'])
+
+	FlagError = False								#Set up error flag
+	if not params['biom_class'] is None:				#Check if the User passed a valid class
+		if  params['biom_class'] in CommonArea['MetadataNames']:
+			params['class'] =  CommonArea['MetadataNames'].index(params['biom_class']) +1	#* Set up the index for that metadata
+		else:
+			FlagError = True
+	if not params['biom_subclass'] is None:				#Check if the User passed a valid subclass
+		if  params['biom_subclass'] in  CommonArea['MetadataNames']:
+			params['subclass'] =  CommonArea['MetadataNames'].index(params['biom_subclass']) +1 #* Set up the index for that metadata
+		else:
+			FlagError = True
+	if FlagError == True:		#* If the User passed an invalid class
+		print "**Invalid biom class or subclass passed - Using defaults: First metadata=class, Second Metadata=subclass\n"
+		params['class'], params['subclass'] = default
 	return params
  	
 	
 
-if  __name__ == '__main__':
-	CommonArea = dict()			#Build a Common Area to pass variables in the biom case
-	params = read_params(sys.argv)
-
-	#*************************************************************
-	#* Conditionally import breadcrumbs if file is a biom file   *
-	#* If it is and no breadcrumbs found - abnormally exit       *
-	#*************************************************************
-	if  params['input_file'].endswith('.biom'):
-		try:
-			from lefsebiom.ConstantsBreadCrumbs import *	 
-			from lefsebiom.AbundanceTable import *
-		except ImportError:
-			sys.stderr.write("************************************************************************************************************ \n")
-			sys.stderr.write("* Error:   Breadcrumbs libraries not detected - required to process biom files - run abnormally terminated * \n")
-			sys.stderr.write("************************************************************************************************************ \n")
-			exit(1)
-
-	
-	if type(params['subclass']) is int and int(params['subclass']) < 1:
-		params['subclass'] = None
-	if type(params['subject']) is int and int(params['subject']) < 1:
-		params['subject'] = None
-
-
-	CommonArea = read_input_file(sys.argv[1], CommonArea)		#Pass The CommonArea to the Read
-	data = CommonArea['ReturnedData']					#Select the data
-
-	if sys.argv[1].endswith('biom'):	#*	Check if biom:
-		params = check_params_for_biom_case(params, CommonArea)	#Check the params for the biom case
-
-	if params['feats_dir'] == "c":
-		data = transpose(data)
+def format_data(data,params):
+	"""Builds the LEfSe input structures (feats, cls, class/subclass slices and
+	class hierarchy) from the rows of an input table, or from a table already
+	split by read_table"""
+	cls_i = [('class',params['class']-1)]
+	if not params['subclass'] is None: cls_i.append(('subclass',params['subclass']-1))
+	if not params['subject'] is None: cls_i.append(('subject',params['subject']-1))
 
-	ncl = 1
-	if not params['subclass'] is None: ncl += 1	
-	if not params['subject'] is None: ncl += 1	
+	if not isinstance(data,dict):
+		if params['feats_dir'] == "c":
+			data = transpose(data)
+		data = table_from_rows(data,[v[1] for v in cls_i])
 
-	first_line = zip(*data)[0]
-	
-	first_line = modify_feature_names(list(first_line))
-
-	data = zip(	first_line,
-			*sort_by_cl(zip(*data)[1:],
-			  ncl,
-			  params['class']-1,
-			  params['subclass']-1 if not params['subclass'] is None else None,
-			  params['subject']-1 if not params['subject'] is None else None))
-#	data.insert(0,first_line)
-#	data = remove_missing(data,params['missing_p'])
+	perm = sort_by_cl([data['meta'][v[1]] for v in cls_i])
 	cls = {}
-
-	cls_i = [('class',params['class']-1)]
-	if params['subclass'] > 0: cls_i.append(('subclass',params['subclass']-1))
-	if params['subject'] > 0: cls_i.append(('subject',params['subject']-1))
-	cls_i.sort(lambda x, y: -cmp(x[1],y[1]))
-	for v in cls_i: cls[v[0]] = data.pop(v[1])[1:]
-	if not params['subclass'] > 0: cls['subclass'] = [str(cl)+"_subcl" for cl in cls['class']]
+	for v in cls_i: cls[v[0]] = tuple([data['meta'][v[1]][i] for i in perm])
+	if params['subclass'] is None: cls['subclass'] = [str(cl)+"_subcl" for cl in cls['class']]
 	
-	cls['subclass'] = rename_same_subcl(cls['class'],cls['subclass'])
 #	if 'subclass' in cls.keys(): cls = group_small_subclasses(cls,params['subcl_min_card'])
-	class_sl,subclass_sl,class_hierarchy = get_class_slices(zip(*cls.values()))
+	cls['subclass'],class_sl,subclass_sl,class_hierarchy = get_class_slices(cls['class'],cls['subclass'])
     
-	feats = dict([(d[0],d[1:]) for d in data])
+	names = modify_feature_names(data['names'])
+	# features sharing a sanitized name keep the values of the last one
+	last = dict([(k,i) for i,k in enumerate(names)])
+	rows = sorted(last.values())
+	x = data['values'][numpy.ix_(rows,perm)]
     
-	feats = add_missing_levels(feats)
+	names,x = add_missing_levels([names[i] for i in rows],x)
     
-	feats = numerical_values(feats,params['norm_v'])
+	feats = FeatureTable(names,x)
+	numerical_values(feats.names,feats.data,params['norm_v'])
 	out = {}
 	out['feats'] = feats
 	out['norm'] = params['norm_v'] 
@@ -440,14 +394,39 @@ if  __name__ == '__main__':
 	out['class_sl'] = class_sl
 	out['subclass_sl'] = subclass_sl
 	out['class_hierarchy'] = class_hierarchy
-
+	return out
+
+def save_data(out,params):
+	"""Writes the output of format_data. The feature table is turned into a
+	dict of lists only for the text table and the pickle, which the Galaxy
+	LEfSe application reads."""
+	cls = out['cls']
+	if params['output_table'] or params['pickle']:
+		feats = dict(zip(out['feats'].names,out['feats'].data.tolist()))
 	if params['output_table']:
 		with open( params['output_table'], "w") as outf: 
 			if 'class' in cls: outf.write( "\t".join(list(["class"])+list(cls['class'])) + "\n" )
 			if 'subclass' in cls: outf.write( "\t".join(list(["subclass"])+list(cls['subclass'])) + "\n" )
 			if 'subject' in cls: outf.write( "\t".join(list(["subject"])+list(cls['subject']))  + "\n" )
-			for k,v in out['feats'].items(): outf.write( "\t".join([k]+[str(vv) for vv in v]) + "\n" )
+			for k,v in feats.items(): outf.write( "\t".join([k]+[str(vv) for vv in v]) + "\n" )
+
+	if params['pickle']:
+		with open(params['output_file'], 'wb') as back_file:
+			pickle.dump(dict(out,feats=feats),back_file)
+	else: save_data_array(out,params['output_file'])
+
 
-	with open(params['output_file'], 'wb') as back_file:
-		pickle.dump(out,back_file)    	
+if  __name__ == '__main__':
+	CommonArea = dict()			#Build a Common Area to pass variables in the biom case
+	params = read_params(sys.argv[1:])
+
+	meta_rows = None
+	if params['feats_dir'] == "r" and not params['input_file'].endswith('.biom'):
+		meta_rows = [v-1 for v in (params['class'],params['subclass'],params['subject']) if not v is None]
+	CommonArea = read_input_file(params['input_file'], CommonArea, meta_rows)		#Pass The CommonArea to the Read
+	data = CommonArea['ReturnedData']					#Select the data
+
+	if params['input_file'].endswith('biom'):	#*	Check if biom:
+		params = check_params_for_biom_case(params, CommonArea)	#Check the params for the biom case
 
+	save_data(format_data(data,params),params)
@@ -1,12 +1,23 @@
-import os,sys,math,pickle
+import os,sys,math,pickle,json,struct
 import random as lrand
-import rpy2.robjects as robjects
 import argparse
 import numpy
+from scipy import stats
+try:
+	import rpy2.robjects as robjects
+except ImportError:
+	robjects = None
 #import svmutil
 
-def init(): 
+r_loaded = False
+
+def init(engine='np'): 
+	global r_loaded
 	lrand.seed(1982)
+	if engine != 'r' or r_loaded: return
+	if robjects is None:
+		raise ImportError('The module """rpy2"" was not found! '
+		'Install it with """pip install rpy2""" or use the native engine (--engine np)')
 	robjects.r('library(splines)')
 	robjects.r('library(stats4)')
 	robjects.r('library(survival)')
@@ -14,17 +25,45 @@ def init():
 	robjects.r('library(modeltools)')
 	robjects.r('library(coin)')
 	robjects.r('library(MASS)')
+	r_loaded = True
+
+class FeatureTable(object):
+	"""Feature by sample values as a single 2D array indexed by feature name.
+	Rows are views of the array, so the steps share it instead of holding
+	lists of Python floats."""
+
+	def __init__(self,names,data):
+		self.names = list(names)
+		data = numpy.asarray(data,dtype=float)
+		if data.ndim != 2: data = data.reshape(len(self.names),-1) if len(self.names) else numpy.zeros((0,0))
+		self.data = data
+		self.index = dict([(k,i) for i,k in enumerate(self.names)])
+
+	@classmethod
+	def from_dict(cls,feats):
+		"""Table of a dict of feature values, as built by format_input.py"""
+		names = sorted(feats.keys())
+		return cls(names,[feats[k] for k in names])
+
+	def __len__(self): return len(self.names)
+	def __iter__(self): return iter(self.names)
+	def __contains__(self,name): return name in self.index
+	def __getitem__(self,name): return self.data[self.index[name]]
+	def keys(self): return list(self.names)
+	def items(self): return zip(self.names,self.data)
+
+	def subset(self,names):
+		"""Copy of the table restricted to the given features, in that order"""
+		return FeatureTable(names,self.data[[self.index[k] for k in names]])
 
 def get_class_means(class_sl,feats):
-	means = {}
 	clk = class_sl.keys()
-	for fk,f in feats.items():
-		means[fk] = [numpy.mean((f[class_sl[k][0]:class_sl[k][1]])) for k in clk] 
-	return clk,means 
+	means = numpy.array([feats.data[:,class_sl[k][0]:class_sl[k][1]].mean(axis=1) for k in clk]).reshape(len(clk),len(feats))
+	return clk,dict(zip(feats.names,means.T.tolist()))
 	
 def save_res(res,filename): 
 	with open(filename, 'w') as out:
-		for k,v in res['cls_means'].items():
+		for k,v in sorted(res['cls_means'].items()):
 			out.write(k+"\t"+str(math.log(max(max(v),1.0),10.0))+"\t")
 			if k in res['lda_res_th']:
 				for i,vv in enumerate(v):
@@ -35,9 +74,60 @@ def save_res(res,filename):
 			else: out.write("\t")
 			out.write( "\t" + (res['wilcox_res'][k] if 'wilcox_res' in res and k in res['wilcox_res'] else "-")+"\n")
 
+FEATS_MAGIC = '\x93LEFSE\x01\x00'
+FEATS_ALIGN = 64
+DRAWS_BUDGET = 1 << 22
+
+def save_data_array(out,filename,dtype='<f8'):
+	"""Writes the output of format_input.py as a JSON header (feature names,
+	class labels, slices) followed by the feature by sample matrix as one
+	contiguous block, aligned so that load_data can memory-map it. The keys
+	of the header are sorted, so that its bytes only depend on the data. The
+	features are a FeatureTable or a dict of their values; their rows are
+	written in name order a chunk at a time, without copying the table."""
+	feats = out['feats']
+	if not isinstance(feats,FeatureTable): feats = FeatureTable.from_dict(feats)
+	order = sorted(range(len(feats)),key=feats.names.__getitem__)
+	names = [feats.names[i] for i in order]
+	header = json.dumps({'dtype': dtype, 'shape': [len(names),len(out['cls']['class'])], 'feats': names, 'norm': out['norm'],
+		'cls': dict([(k,list(v)) for k,v in out['cls'].items()]),
+		'class_sl': dict([(k,[int(v[0]),int(v[1])]) for k,v in out['class_sl'].items()]),
+		'subclass_sl': dict([(k,[int(v[0]),int(v[1])]) for k,v in out['subclass_sl'].items()]),
+		'class_hierarchy': dict([(k,list(v)) for k,v in out['class_hierarchy'].items()])},sort_keys=True)
+	header += ' '*(-(len(FEATS_MAGIC)+8+len(header)) % FEATS_ALIGN)
+	with open(filename, 'wb') as outf:
+		outf.write(FEATS_MAGIC)
+		outf.write(struct.pack('<Q',len(header)))
+		outf.write(header)
+		for i in range(0,len(order),1024):
+			numpy.asarray(feats.data[order[i:i+1024]],dtype=dtype).tofile(outf)
+
+def load_data_array(inputf):
+	"""Reads a file written by save_data_array from after its magic. The
+	feature values are a copy-on-write memory map of the file, the names are
+	UTF-8 strings as they were written."""
+	hlen = struct.unpack('<Q',inputf.read(8))[0]
+	header = json.loads(inputf.read(hlen))
+	shape = tuple(header['shape'])
+	if shape[0]*shape[1]: data = numpy.memmap(inputf.name,dtype=str(header['dtype']),mode='c',offset=len(FEATS_MAGIC)+8+hlen,shape=shape)
+	else: data = numpy.zeros(shape)
+	utf8 = lambda u: u.encode('utf-8')
+	return {'feats': FeatureTable([utf8(k) for k in header['feats']],data),
+		'norm': header['norm'],
+		'cls': dict([(utf8(k),tuple([utf8(vv) for vv in v])) for k,v in header['cls'].items()]),
+		'class_sl': dict([(utf8(k),tuple(v)) for k,v in header['class_sl'].items()]),
+		'subclass_sl': dict([(utf8(k),tuple(v)) for k,v in header['subclass_sl'].items()]),
+		'class_hierarchy': dict([(utf8(k),[utf8(vv) for vv in v]) for k,v in header['class_hierarchy'].items()])}
+
 def load_data(input_file, nnorm = False):
+	"""Loads the output of format_input.py, either an array container or a
+	pickle as written by earlier versions"""
 	with open(input_file, 'rb') as inputf:
-		inp = pickle.load(inputf)
+		if inputf.read(len(FEATS_MAGIC)) == FEATS_MAGIC: inp = load_data_array(inputf)
+		else:
+			inputf.seek(0)
+			inp = pickle.load(inputf)
+			inp['feats'] = FeatureTable.from_dict(inp['feats'])
 	if nnorm: return inp['feats'],inp['cls'],inp['class_sl'],inp['subclass_sl'],inp['class_hierarchy'],inp['norm']  
 	else: return inp['feats'],inp['cls'],inp['class_sl'],inp['subclass_sl'],inp['class_hierarchy']
 
@@ -59,8 +149,74 @@ def test_kw_r(cls,feats,p,factors):
 	kw_res = robjects.r('kruskal.test('+fo+',)$p.value')
 	return float(tuple(kw_res)[0]) < p, float(tuple(kw_res)[0])
 
+def rank_rows(x):
+	"""Mid-ranks of every row of x, ties getting their average rank as in R's
+	rank(). Also returns the tie term sum(t^3-t) of each row."""
+	x = numpy.atleast_2d(numpy.asarray(x,dtype=float))
+	nr,nc = x.shape
+	rows = numpy.arange(nr)[:,None]
+	pos = numpy.arange(nc)[None,:]
+	order = numpy.argsort(x,axis=1,kind='mergesort')
+	xs = x[rows,order]
+	first = numpy.ones(x.shape,dtype=bool)
+	first[:,1:] = xs[:,1:] != xs[:,:-1]
+	last = numpy.ones(x.shape,dtype=bool)
+	last[:,:-1] = first[:,1:]
+	start = numpy.maximum.accumulate(numpy.where(first,pos,0),axis=1)
+	end = numpy.minimum.accumulate(numpy.where(last,pos,nc)[:,::-1],axis=1)[:,::-1]
+	ranks = numpy.empty(x.shape)
+	ranks[rows,order] = (start+end)*0.5+1.0
+	t = end-start+1.0
+	return ranks,(t*t-1.0).sum(axis=1)
+
+def kw_pvalues(cl,x):
+	"""Kruskal-Wallis p-values (with tie correction, as kruskal.test) of every
+	row of the feature-by-sample matrix x against the sample labels cl."""
+	ranks,ties = rank_rows(x)
+	n = float(ranks.shape[1])
+	lev,codes = numpy.unique(numpy.asarray(cl),return_inverse=True)
+	g = numpy.zeros((len(codes),len(lev)))
+	g[numpy.arange(len(codes)),codes] = 1.0
+	with numpy.errstate(divide='ignore',invalid='ignore'):
+		h = (ranks.dot(g)**2/g.sum(axis=0)).sum(axis=1)
+		h = (12.0*h/(n*(n+1.0))-3.0*(n+1.0))/(1.0-ties/(n**3-n))
+		return stats.chi2.sf(h,len(lev)-1)
+
+def test_kw_np(cls,feats,p,factors):
+	pvs = kw_pvalues(cls[factors[0]],feats.data)
+	return dict([(k,(bool(pvs[i] < p),float(pvs[i]))) for i,k in enumerate(feats.names)])
+
+def wilcoxon_pvalues(feats,sl,keys):
+	"""Two-sided asymptotic Wilcoxon rank-sum p-values (conditional variance
+	with ties, as coin::wilcox_test) between every pair of the slices keys of
+	the feature values, computed together from the per-slice value counts."""
+	x = numpy.asarray(feats,dtype=float)
+	vals,codes = numpy.unique(x,return_inverse=True)
+	cnt = numpy.array([numpy.bincount(codes[sl[k][0]:sl[k][1]],minlength=len(vals)) for k in keys],dtype=float)
+	less = numpy.cumsum(cnt,axis=1)-cnt
+	n = cnt.sum(axis=1)
+	n1,n2 = n[:,None],n[None,:]
+	nt = n1+n2
+	u = cnt.dot((less+0.5*cnt).T)
+	c2 = cnt*cnt
+	c3 = (c2*cnt).sum(axis=1)
+	ties = c3[:,None]+c3[None,:]+3.0*c2.dot(cnt.T)+3.0*cnt.dot(c2.T)-nt
+	with numpy.errstate(divide='ignore',invalid='ignore'):
+		var = n1*n2/12.0*((nt+1.0)-ties/(nt*(nt-1.0)))
+		z = (u-n1*n2*0.5)/numpy.sqrt(var)
+		return 2.0*stats.norm.sf(numpy.abs(z))
+
 def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,comp_only_same_subcl,curv=False):
+	return test_rep_wilcoxon(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,comp_only_same_subcl,curv,'r')
+
+def test_rep_wilcoxon(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,comp_only_same_subcl,curv=False,engine='np'):
 	comp_all_sub = not comp_only_same_subcl
+	if engine == 'np':
+		slk = sl.keys()
+		ski = dict([(k,i) for i,k in enumerate(slk)])
+		pvs = wilcoxon_pvalues(feats,sl,slk)
+		meds = dict([(k,numpy.median(feats[sl[k][0]:sl[k][1]])) for k in slk])
+		single = dict([(k,len(set(feats[sl[k][0]:sl[k][1]])) == 1) for k in slk])
 	tot_ok =  0
 	alpha_mtc = th
 	all_diff = []
@@ -82,11 +238,18 @@ def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,com
 				med_comp = False
 				if len(cl1) < min_c or len(cl2) < min_c: 
 					med_comp = True
-				sx,sy = numpy.median(cl1),numpy.median(cl2)
-				if cl1[0] == cl2[0] and len(set(cl1)) == 1 and  len(set(cl2)) == 1: 
+				if engine == 'np':
+					sx,sy = meds[k1],meds[k2]
+					const = cl1[0] == cl2[0] and single[k1] and single[k2]
+				else:
+					sx,sy = numpy.median(cl1),numpy.median(cl2)
+					const = cl1[0] == cl2[0] and len(set(cl1)) == 1 and  len(set(cl2)) == 1
+				if const: 
 					tres, first = False, False
+				elif not med_comp and engine == 'np':
+					tres = pvs[ski[k1],ski[k2]] < alpha_mtc*2.0
 				elif not med_comp:
-					robjects.globalenv["x"] = robjects.FloatVector(cl1+cl2)
+					robjects.globalenv["x"] = robjects.FloatVector(list(cl1)+list(cl2))
 					robjects.globalenv["y"] = robjects.FactorVector(robjects.StrVector(["a" for a in cl1]+["b" for b in cl2]))	
 					pv = float(robjects.r('pvalue(wilcox_test(x~y,data=data.frame(x,y)))')[0])
 					tres = pv < alpha_mtc*2.0
@@ -131,87 +294,221 @@ def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,com
 
 
 
-def contast_within_classes_or_few_per_class(feats,inds,min_cl,ncl):
-	ff = zip(*[v for n,v in feats.items() if n != 'class'])
-	cols = [ff[i] for i in inds]
-	cls = [feats['class'][i] for i in inds]
-	if len(set(cls)) < ncl:
-		return True
-	for c in set(cls):
-		if cls.count(c) < min_cl:
-			return True
-		cols_cl = [x for i,x in enumerate(cols) if cls[i] == c]
-		for i,col in enumerate(zip(*cols_cl)):
-			if (len(set(col)) <= min_cl and min_cl > 1) or (min_cl == 1 and len(set(col)) <= 1):
-				return True
-	return False 
+def feasibility_index(x,yc,ncl,min_cl):
+	"""Precomputes the checks of the LDA bootstrap draws on the samples (rows)
+	of x with class codes yc. A (feature, class) pair without tied values has
+	as many distinct values in a draw as distinct samples of the class drawn,
+	so only the pairs with ties need their value groups: a pair by sample
+	matrix of group codes, the groups of a pair being contiguous from
+	pair_start and followed by one trash slot for the samples of the other
+	classes. The pairs with the fewest values, which reject the most draws,
+	come first. The draws can be accepted at all only if every pair has more
+	than min_cl distinct values in the whole class."""
+	codes,pair_start,pair_nvals,tied_nvals = [],[],[],[]
+	ng = 0
+	for c in range(ncl):
+		idx = numpy.flatnonzero(yc == c)
+		order = numpy.argsort(x[idx],axis=0,kind='mergesort')
+		vals = x[idx][order,numpy.arange(x.shape[1])[None,:]]
+		new = numpy.ones(vals.shape,dtype=bool)
+		new[1:] = vals[1:] != vals[:-1]
+		nvals = new.sum(axis=0)
+		pair_nvals.append(nvals)
+		tied = numpy.flatnonzero(nvals < len(idx))
+		if not len(tied): continue
+		gid = (numpy.cumsum(new[:,tied].T.ravel())-1).reshape(len(tied),-1)
+		block = numpy.empty((len(tied),len(yc)),dtype=numpy.int32)
+		block.fill(-1)
+		block[numpy.arange(len(tied))[:,None],idx[order[:,tied]].T] = gid+ng
+		codes.append(block)
+		pair_start.append(gid[:,0]+ng)
+		tied_nvals.append(nvals[tied])
+		ng += int(gid[-1,-1])+1
+	index = {'ncl': ncl, 'min_cl': min_cl, 'yc': yc, 'ngroups': ng, 'npairs': 0}
+	index['feasible'] = bool(min([nv.min() for nv in pair_nvals]) > min_cl) if len(pair_nvals) else False
+	index['onehot'] = numpy.zeros((len(yc),ncl),dtype=numpy.int32)
+	index['onehot'][numpy.arange(len(yc)),yc] = 1
+	if ng:
+		tied_nvals = numpy.concatenate(tied_nvals)
+		order = numpy.argsort(tied_nvals,kind='mergesort')
+		start = numpy.concatenate([[0],numpy.cumsum(tied_nvals[order]+1)[:-1]])
+		trash = start+tied_nvals[order]
+		codes = numpy.vstack(codes)[order]
+		codes = numpy.where(codes < 0,trash[:,None],codes+(start-numpy.concatenate(pair_start)[order])[:,None])
+		index['codes'] = codes.astype(numpy.int32)
+		index['pair_start'],index['trash'],index['npairs'] = start,trash,len(start)
+	return index
+
+def draws_per_check(index):
+	"""Number of draws checked at once, so that their sample and value group
+	marks stay within DRAWS_BUDGET elements"""
+	return max(1,DRAWS_BUDGET//(len(index['yc'])+index['ngroups']+index['npairs']))
+
+def rejected_draws(draws,index,first_pairs=16):
+	"""Whether each draw (row of sample indices, with repetitions) misses a
+	class, has less than min_cl samples in a class or at most min_cl distinct
+	values of a feature within a class. The tied pairs are checked in growing
+	blocks, each on the draws that the blocks before did not reject."""
+	step = draws_per_check(index)
+	if len(draws) > step:
+		return numpy.concatenate([rejected_draws(draws[i:i+step],index,first_pairs) for i in range(0,len(draws),step)])
+	m,ncl,min_cl = len(draws),index['ncl'],index['min_cl']
+	rows = numpy.arange(m)[:,None]
+	cnt = numpy.bincount((index['yc'][draws]+ncl*rows).ravel(),minlength=m*ncl).reshape(m,ncl)
+	rej = (cnt < min_cl).any(axis=1)
+	drawn = numpy.zeros((m,len(index['yc'])),dtype=bool)
+	drawn[rows,draws] = True
+	rej |= (drawn.dot(index['onehot']) <= min_cl).any(axis=1)
+	left = numpy.flatnonzero(~rej)
+	if not len(left) or not index['npairs']: return rej
+	samples = [numpy.flatnonzero(drawn[i]) for i in range(m)]
+	lo,nb = 0,first_pairs
+	while len(left) and lo < index['npairs']:
+		hi = min(lo+nb,index['npairs'])
+		s0 = index['pair_start'][lo]
+		codes = index['codes'][lo:hi]-s0
+		# slots of the block hit by each draw, trash slots included
+		mark = numpy.zeros((len(left),index['trash'][hi-1]+1-s0),dtype=bool)
+		for j,i in enumerate(left):
+			mark[j][codes[:,samples[i]]] = True
+		nvals = numpy.add.reduceat(mark,index['pair_start'][lo:hi]-s0,axis=1,dtype=numpy.int32)-mark[:,index['trash'][lo:hi]-s0]
+		bad = (nvals <= min_cl).any(axis=1)
+		rej[left[bad]] = True
+		left = left[~bad]
+		lo,nb = hi,nb*4
+	return rej
+
+def draw_bootstraps(boots,lfk,rfk,index,max_draws=1000):
+	"""Draws rfk of the lfk samples (with replacement) for every bootstrap,
+	redrawing the rejected draws up to max_draws times as LEfSe does; the last
+	draw is kept if all are rejected. Candidates are drawn and checked in
+	growing batches for all the pending bootstraps at once, up to the draws
+	checked at once."""
+	rs = numpy.random.RandomState(lrand.randint(0,2**31-1))
+	if not index['feasible']:
+		return rs.randint(0,lfk,size=(boots,rfk))
+	draws = numpy.empty((boots,rfk),dtype=int)
+	pending = numpy.arange(boots)
+	tries,nb = 0,4
+	while len(pending) and tries < max_draws:
+		nb = min(nb,max_draws-tries,max(1,draws_per_check(index)//len(pending)))
+		cand = rs.randint(0,lfk,size=(len(pending),nb,rfk))
+		ok = ~rejected_draws(cand.reshape(-1,rfk),index).reshape(len(pending),nb)
+		found = ok.any(axis=1)
+		first = numpy.where(found,ok.argmax(axis=1),nb-1)
+		draws[pending] = cand[numpy.arange(len(pending)),first]
+		pending = pending[~found]
+		tries += nb
+		nb *= 2
+	return draws
+
+def lda_fit(x,y,tol):
+	"""Linear discriminant analysis of the samples (rows) of x as MASS::lda
+	(method "moment"). Returns the classes, the class means and the scaling
+	matrix. Variables constant within classes get a null scaling instead of
+	stopping the fit as lda() does."""
+	n,p = x.shape
+	lev,g = numpy.unique(y,return_inverse=True)
+	ng = len(lev)
+	counts = numpy.bincount(g).astype(float)
+	ind = numpy.zeros((n,ng))
+	ind[numpy.arange(n),g] = 1.0
+	means = ind.T.dot(x)/counts[:,None]
+	scaling = numpy.zeros((p,0))
+	if ng < 2: return lev,means,scaling
+	xc = x-means[g]
+	f1 = numpy.sqrt((xc*xc).sum(axis=0)/(n-1.0))
+	ok = f1 >= tol
+	if not ok.any(): return lev,means,scaling
+	xs = xc[:,ok]*(numpy.sqrt(1.0/(n-ng))/f1[ok])
+	d,vt = numpy.linalg.svd(xs,full_matrices=False)[1:]
+	rank = int((d > tol).sum())
+	if rank == 0: return lev,means,scaling
+	sc = vt[:rank].T/(f1[ok][:,None]*d[:rank])
+	prior = counts/float(n)
+	xbar = prior.dot(means[:,ok])
+	xb = numpy.sqrt(n*prior/(ng-1.0))[:,None]*(means[:,ok]-xbar).dot(sc)
+	d,vt = numpy.linalg.svd(xb,full_matrices=False)[1:]
+	rank = int((d > tol*d[0]).sum())
+	scaling = numpy.zeros((p,rank))
+	scaling[ok] = sc.dot(vt[:rank].T)
+	return lev,means,scaling
 
 def test_lda_r(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nlogs):
-        fk = feats.keys()
-        means = dict([(k,[]) for k in feats.keys()])
-        feats['class'] = list(cls['class'])
-        clss = list(set(feats['class']))
-        for uu,k in enumerate(fk):
-                if k == 'class': continue
-                ff = [(feats['class'][i],v) for i,v in enumerate(feats[k])]
-                for c in clss:
-                        if len(set([float(v[1]) for v in ff if v[0] == c])) > max(float(feats['class'].count(c))*0.5,4): continue
-                        for i,v in enumerate(feats[k]):
-                                if feats['class'][i] == c:
-                                        feats[k][i] = math.fabs(feats[k][i] + lrand.normalvariate(0.0,max(feats[k][i]*0.05,0.01)))
-        rdict = {}
-        for a,b in feats.items():
-                if a == 'class' or a == 'subclass' or a == 'subject':
-                        rdict[a] = robjects.StrVector(b)
-                else: rdict[a] = robjects.FloatVector(b)
-        robjects.globalenv["d"] = robjects.DataFrame(rdict)
-        lfk = len(feats[fk[0]])
-        rfk = int(float(len(feats[fk[0]]))*fract_sample)
-        f = "class ~ "+fk[0]
-        for k in fk[1:]: f += " + " + k.strip()
-        ncl = len(set(cls['class']))
-        min_cl = int(float(min([cls['class'].count(c) for c in set(cls['class'])]))*fract_sample*fract_sample*0.5) 
-        min_cl = max(min_cl,1) 
-        pairs = [(a,b) for a in set(cls['class']) for b in set(cls['class']) if a > b]
-
-	for k in fk:	
-		for i in range(boots):
-			means[k].append([])	
-        for i in range(boots):
-                for rtmp in range(1000):
-                        rand_s = [lrand.randint(0,lfk-1) for v in range(rfk)]
-                        if not contast_within_classes_or_few_per_class(feats,rand_s,min_cl,ncl): break
-                rand_s = [r+1 for r in rand_s]
-		means[k][i] = []
-		for p in pairs:
-	        	robjects.globalenv["rand_s"] = robjects.IntVector(rand_s)
-                	robjects.globalenv["sub_d"] = robjects.r('d[rand_s,]')
-                	z = robjects.r('z <- suppressWarnings(lda(as.formula('+f+'),data=sub_d,tol='+str(tol_min)+'))')
+	return test_lda(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nlogs,'r')
+
+def test_lda(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nlogs,engine='np'):
+	fk = sorted(feats.keys())
+	xm = feats.subset(fk).data
+	ym = numpy.array(cls['class'])
+	clss = list(set(cls['class']))
+	# jitter the values of the classes in which a feature has few distinct
+	# values, the draws follow the feature, class and sample order
+	jit = numpy.zeros(xm.shape,dtype=bool)
+	for c in clss:
+		sel = ym == c
+		vals = numpy.sort(xm[:,sel],axis=1)
+		jit[:,sel] = ((vals[:,1:] != vals[:,:-1]).sum(axis=1)+1 <= max(float(sel.sum())*0.5,4))[:,None]
+	order = numpy.argsort([clss.index(c) for c in cls['class']],kind='mergesort')
+	xo,jo = xm[:,order],jit[:,order]
+	v = xo[jo]
+	xo[jo] = numpy.abs(v + numpy.array([lrand.normalvariate(0.0,1.0) for i in range(len(v))])*numpy.maximum(v*0.05,0.01))
+	xm[:,order] = xo
+	xm = numpy.ascontiguousarray(xm.T)
+	if engine == 'r':
+		rdict = dict([(k,robjects.FloatVector(xm[:,j])) for j,k in enumerate(fk)])
+		rdict['class'] = robjects.StrVector(cls['class'])
+		robjects.globalenv["d"] = robjects.DataFrame(rdict)
+		f = "class ~ "+fk[0]
+		for k in fk[1:]: f += " + " + k.strip()
+	lfk = len(ym)
+	rfk = int(float(lfk)*fract_sample)
+	ncl = len(set(cls['class']))
+	min_cl = int(float(min([cls['class'].count(c) for c in set(cls['class'])]))*fract_sample*fract_sample*0.5) 
+	min_cl = max(min_cl,1) 
+	pairs = [(a,b) for a in set(cls['class']) for b in set(cls['class']) if a > b]
+
+	scores = numpy.zeros((boots,len(pairs),len(fk)))
+	yc = numpy.unique(ym,return_inverse=True)[1]
+	all_draws = draw_bootstraps(boots,lfk,rfk,feasibility_index(xm,yc,ncl,min_cl))
+	for i in range(boots):
+		rand_s = all_draws[i]
+		if engine == 'np':
+			sub_x,sub_y = xm[rand_s],ym[rand_s]
+			lev,mm,scaling = lda_fit(sub_x,sub_y,tol_min)
+			rowns = list(lev)
+			w = scaling[:,0] if scaling.shape[1] else numpy.zeros(len(fk))
+			with numpy.errstate(divide='ignore',invalid='ignore'):
+				w_unit = w/numpy.sqrt((w*w).sum())
+				ld = sub_x.dot(w_unit)
+				ld_means = dict([(c,ld[sub_y == c].mean() if c in rowns else numpy.nan) for c in clss])
+			cl_means = dict([(c,mm[rowns.index(c)] if c in rowns else numpy.zeros(len(fk))) for c in clss])
+			for pi,p in enumerate(pairs):
+				coeff = numpy.abs(w_unit*abs(ld_means[p[0]] - ld_means[p[1]]))
+				coeff[numpy.isnan(coeff)] = 0.0
+				scores[i,pi] = (numpy.abs(cl_means[p[0]] - cl_means[p[1]])+coeff)*0.5
+		else:
+			robjects.globalenv["rand_s"] = robjects.IntVector([int(r)+1 for r in rand_s])
+			robjects.globalenv["sub_d"] = robjects.r('d[rand_s,]')
+			z = robjects.r('z <- suppressWarnings(lda(as.formula('+f+'),data=sub_d,tol='+str(tol_min)+'))')
 			robjects.r('w <- z$scaling[,1]')
 			robjects.r('w.unit <- w/sqrt(sum(w^2))')
 			robjects.r('ss <- sub_d[,-match("class",colnames(sub_d))]')
-			if 'subclass' in feats:
-				robjects.r('ss <- ss[,-match("subclass",colnames(ss))]')
-			if 'subject' in feats:
-				robjects.r('ss <- ss[,-match("subject",colnames(ss))]')
 			robjects.r('xy.matrix <- as.matrix(ss)')
 			robjects.r('LD <- xy.matrix%*%w.unit')
-			robjects.r('effect.size <- abs(mean(LD[sub_d[,"class"]=="'+p[0]+'"]) - mean(LD[sub_d[,"class"]=="'+p[1]+'"]))')
-			scal = robjects.r('wfinal <- w.unit * effect.size')
 			rres = robjects.r('mm <- z$means')
 			rowns = list(rres.rownames)
 			lenc = len(list(rres.colnames))
-			coeff = [abs(float(v)) if not math.isnan(float(v)) else 0.0 for v in scal]
-                	res = dict([(pp,[float(ff) for ff in rres.rx(pp,True)] if pp in rowns else [0.0]*lenc ) for pp in [p[0],p[1]]])
-			for j,k in enumerate(fk):
-				gm = abs(res[p[0]][j] - res[p[1]][j])
-                        	means[k][i].append((gm+coeff[j])*0.5)
-        res = {}
-        for k in fk:
-		m = max([numpy.mean([means[k][kk][p] for kk in range(boots)]) for p in range(len(pairs))])
-                res[k] = math.copysign(1.0,m)*math.log(1.0+math.fabs(m),10)
-        return res,dict([(k,x) for k,x in res.items() if math.fabs(x) > lda_th])
-
+			for pi,p in enumerate(pairs):
+				robjects.r('effect.size <- abs(mean(LD[sub_d[,"class"]=="'+p[0]+'"]) - mean(LD[sub_d[,"class"]=="'+p[1]+'"]))')
+				scal = robjects.r('wfinal <- w.unit * effect.size')
+				coeff = numpy.array([abs(float(v)) if not math.isnan(float(v)) else 0.0 for v in scal])
+				res = dict([(pp,numpy.array([float(ff) for ff in rres.rx(pp,True)]) if pp in rowns else numpy.zeros(lenc)) for pp in [p[0],p[1]]])
+				scores[i,pi] = (numpy.abs(res[p[0]] - res[p[1]])+coeff)*0.5
+	# average over the bootstraps, one contiguous row per feature and pair
+	m = numpy.ascontiguousarray(scores.transpose(2,1,0)).mean(axis=2).max(axis=1)
+	res = dict([(k,math.copysign(1.0,m[j])*math.log(1.0+math.fabs(m[j]),10)) for j,k in enumerate(fk)])
+	return res,dict([(k,x) for k,x in res.items() if math.fabs(x) > lda_th])
 
 def test_svm(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nsvm):
 	return NULL
@@ -2,6 +2,7 @@
 
 import os,sys,matplotlib,argparse,string
 matplotlib.use('Agg')
+import matplotlib.collections,matplotlib.patches,matplotlib.markers,matplotlib.transforms
 from pylab import *
 from lefse import *
 import numpy as np
@@ -71,70 +72,89 @@ def read_params(args):
 	parser.add_argument('--background_color',dest="back_color", type=str, choices=["k","w"], default="w", help="set the color of the background")
 	parser.add_argument('--colored_labels',dest="col_lab", type=int, choices=[0,1], default=1, help="draw the label with class color (1) or in black (0)")
 	parser.add_argument('--class_legend_font_size',dest="class_legend_font_size", type=str, default="10")
-	parser.add_argument('--dpi',dest="dpi", type=int, default=72)
-	parser.add_argument('--format', dest="format", choices=["png","svg","pdf"], default="svg", type=str, help="the format for the output file")
+	parser.add_argument('--dpi',dest="dpi", type=int, nargs='+', default=[72], help="the resolution(s) of the raster (png) outputs")
+	parser.add_argument('--format', dest="format", choices=["png","svg","pdf"], nargs='+', default=["svg"], type=str, help="the format(s) for the output file, all saved from the same figure")
 	parser.add_argument('--all_feats', dest="all_feats", type=str, default="")
-	args = parser.parse_args()
-	return vars(args) 
-
-def cmp_names(la,lb):
-	if len(la) != len(lb): return False
-	for p in [(a,b) for i,a in enumerate(la) for j,b in enumerate(lb) if i == j]:
-		if p[0] != p[1]: return False
-	return True	
+	parser.add_argument('--batch', dest="batch", action='store_true', help="INPUT_FILE lists the result files of several timepoints (one per line, optionally followed by a tab and a title), drawn on one shared layout into the OUTPUT_FILE folder")
+	args = parser.parse_args(args)
+	params = vars(args)
+	params['fore_color'] = 'w' if params['back_color'] == 'k' else 'k'
+	return params
 
 def build_tree(father,all_nodes,l,depth,viz):
-	cc = [n for n in all_nodes if len(n.name) > len(father.name) and cmp_names(father.name,n.name[:len(father.name)])]
-	children = [n for n in cc if len(n.name) == len(father.name)+1]
-	if len(children) == 0 and l < depth -1: # !!!
-		nc = CladeNode(father.id+"."+father.id.split(".")[-1],1.0,viz)
-		father.add_child(nc)
-		children.append(nc)
-	for child in children:
-		build_tree(child,cc,l+1,depth,viz)
-		father.add_child(child)
+	"""Links all_nodes below father in one pass over a trie of the nodes keyed
+	by their parent name. Leaves above depth get placeholder children down to
+	it (visible if viz). Iterative, so deep taxonomies do not recurse."""
+	children = {}
+	for n in all_nodes:
+		children.setdefault(tuple(n.name[:-1]),{})[n.last_name] = n
+	stack = [(father,l)]
+	while stack:
+		node,l = stack.pop()
+		cc = children.get(tuple(node.name),{}).values()
+		if len(cc) == 0 and l < depth -1: # !!!
+			cc = [CladeNode(node.id+"."+node.id.split(".")[-1],1.0,viz)]
+		for child in cc:
+			node.add_child(child)
+			stack.append((child,l+1))
 
 def get_all_nodes(father):
-	ret = [father]
-	children = father.get_children()
-	for c in children:
-		ret += get_all_nodes(c)
+	ret = []
+	stack = [father]
+	while stack:
+		n = stack.pop()
+		ret.append(n)
+		stack += reversed(n.get_children())
 	return ret
 
-def read_data(input_file,params):
+def read_rows(input_file,params):
+	"""Reads the run_lefse results in one streaming pass, keeping the name,
+	abundance and class of the features within max_lev and sub_clade"""
+	prefix = params['sub_clade']+"." if params['sub_clade'] != "" else ""
+	rows = []
 	with open(input_file, 'r') as inp:
-		if params['sub_clade'] == "": rows = [line.strip().split()[:-1] for line in inp.readlines() if params['max_lev'] < 1 or line.split()[0].count(".") < params['max_lev']]
-		else: rows = [line.split(params['sub_clade']+".")[1].strip().split()[:-1] for line in inp.readlines() if ( params['max_lev'] < 1 or line.split()[0].count(".") < params['max_lev'] ) and line.startswith(params['sub_clade']+".")]
-	all_names = [lin[0] for lin in rows]
-	to_add = []
+		for line in inp:
+			row = line.split()
+			if len(row) == 0: continue
+			if params['max_lev'] >= 1 and row[0].count(".") >= params['max_lev']: continue
+			if prefix:
+				if not line.startswith(prefix): continue
+				row[0] = row[0][len(prefix):]
+			rows.append(row[:-1])
+	return rows
 
-	abundances = [float(v) for v in zip(*rows)[1] if v >= 0.0]
+def class_color(v,cls2,class_i):
+	"""Color of the class of a result row, 'y' if the feature is not discriminative"""
+	if len(v) <= 2: return 'y'
+	if len(cls2) > 0: return colors[cls2.index(v[2])%len(colors)]
+	if v[2].count('rgbcol') > 0: return [float(tt) for tt in v[2].split('_')[1:]]
+	return colors[class_i[v[2]]%len(colors)]
+
+def make_tree(rows,params):
+	"""Builds the clade tree of the result rows, adding the missing ancestors
+	of the features with hashed name lookups"""
 	tree = {}
 	tree['classes'] = list(set([v[2] for v in rows if len(v)>2]))
 	tree['classes'].sort()
 	all_nodes = [CladeNode("root."+row[0],float(row[1])) for row in rows]
+	abundances = [n.abundance for n in all_nodes]
 
 	depth = max([len(n.name) for n in all_nodes])
 
-	n2 = ["_".join(nn.name) for nn in all_nodes]
-	for i,nn in enumerate(all_nodes):
+	names = set([tuple(n.name) for n in all_nodes])
+	for nn in all_nodes[:]:
 		n = nn
-		while "_".join(n.name[:-1]) not in n2 and len(n.name) > 1:
+		while len(n.name) > 1 and tuple(n.name[:-1]) not in names:
 			n = CladeNode(".".join(n.name[:-1]),n.abundance)
 			all_nodes.append(n)
-			n2.append("_".join(n.name))
+			names.add(tuple(n.name))
 
+	class_i = dict([(c,i) for i,c in enumerate(tree['classes'])])
 	cls2 = []
         if params['all_feats'] != "":
                 cls2 = sorted(params['all_feats'].split(":"))
 	for i,v in enumerate(rows):
-		if len(v)>2:
-			if len(cls2) > 0: all_nodes[i].set_color(colors[cls2.index(v[2])%len(colors)])
-			else: 
-				if v[2].count('rgbcol') > 0:
-					ccc = [float(tt) for tt in v[2].split('_')[1:]]
-					all_nodes[i].set_color(ccc)
-				else: all_nodes[i].set_color(colors[sorted(tree['classes']).index(v[2])%len(colors)])	
+		all_nodes[i].set_color(class_color(v,cls2,class_i))
 	root = CladeNode("root",-1.0)
 	root.set_pos((0.0,0.0))
 
@@ -145,69 +165,144 @@ def read_data(input_file,params):
 	tree['root'] = root
 	tree['max_abs'] = max(abundances)
 	tree['min_abs'] = min(abundances)
-	levs = []
-	for i in range(depth):
-		depthi = [n for n in all_nodes if len(n.name) == i+1]
-		levs.append(len(depthi))
+	levs = [0]*depth
+	for n in all_nodes: levs[len(n.name)-1] += 1
 	tree['nlev'] = levs
 	return tree
 
+def read_data(input_file,params):
+	return make_tree(read_rows(input_file,params),params)
+
+def read_batch(input_files,params):
+	"""Reads the results of several timepoints and builds the union of their
+	clade trees once. Each timepoint is kept as the changes of abundance and
+	color of the union nodes from the timepoint before; the features missing
+	at a timepoint are drawn as not discriminative with the smallest point.
+	The classes are colored the same at every timepoint (all_feats, all the
+	classes of the batch by default), without changing params."""
+	data = [read_rows(f,params) for f in input_files]
+	classes = sorted(set([v[2] for rows in data for v in rows if len(v)>2]))
+	params = dict(params,all_feats=params['all_feats'] if params['all_feats'] != "" else ":".join(classes))
+	cls2 = sorted(params['all_feats'].split(":"))
+	class_i = dict([(c,i) for i,c in enumerate(cls2)])
+
+	union,urows = set(),[]
+	for rows in data:
+		for v in rows:
+			if v[0] in union: continue
+			union.add(v[0])
+			urows.append(v[:2])
+	tree = make_tree(urows,params)
+	abundances = [float(v[1]) for rows in data for v in rows]
+	tree['max_abs'] = max(abundances)
+	tree['min_abs'] = min(abundances)
+
+	nodes = dict([(n.id,n) for n in get_all_nodes(tree['root']) if n.id[5:] in union])
+	current = dict([(nid,(n.abundance,n.get_color())) for nid,n in nodes.items()])
+	absent = (tree['min_abs'],'y')
+	states = []
+	for rows in data:
+		state = dict([("root."+v[0],(float(v[1]),class_color(v,cls2,class_i))) for v in rows])
+		changes = []
+		for nid,n in nodes.items():
+			new = state.get(nid,absent)
+			if new != current[nid]:
+				changes.append((n,new[0],new[1]))
+				current[nid] = new
+		states.append({'changes':changes,'classes':sorted(set([v[2] for v in rows if len(v)>2]))})
+	return {'tree':tree,'states':states,'all_feats':params['all_feats']}
+
+def set_state(batch,state):
+	"""Moves the shared tree to the next timepoint of the batch, updating only
+	the nodes that changed"""
+	for n,abundance,col in state['changes']:
+		n.abundance = abundance
+		n.set_color(col)
+	batch['tree']['classes'] = state['classes']
+
 def add_all_pos(father,n,distn,seps,tsep,mlev,last_leaf=-1,nc=1):
-	children = father.get_children()
-	leaves = True if children[0].isleaf else False
-	for i,child in enumerate(children):
-		if leaves:
-			n += 1.0
-			men = 0.5 if len(children) == 1 else 0.0
-			child.set_pos((n*distn-men*float(distn)+tsep,(len(father.name))/float(mlev-1)))
-			if last_leaf != -1:
-				child.prev_leaf = last_leaf
-				last_leaf.next_leaf = child
-			last_leaf = child
-		else:
-			ln = n
-			ltsep = tsep 
-			n,tsep,last_leaf = add_all_pos(child,n,distn,seps,tsep,mlev,last_leaf,len(children))
+	"""Places the nodes below father: leaves in order around the circle, every
+	other node halfway between its first and last leaves. Walks the tree with
+	an explicit stack, so deep taxonomies do not recurse."""
+	stack = [('enter',father)]
+	while stack:
+		step = stack.pop()
+		if step[0] == 'enter':
+			node = step[1]
+			children = node.get_children()
+			if not children[0].isleaf:
+				stack.append(('exit',node))
+				stack += [('child',child,node) for child in reversed(children)]
+				continue
+			for child in children:
+				n += 1.0
+				men = 0.5 if len(children) == 1 else 0.0
+				child.set_pos((n*distn-men*float(distn)+tsep,(len(node.name))/float(mlev-1)))
+				if last_leaf != -1:
+					child.prev_leaf = last_leaf
+					last_leaf.next_leaf = child
+				last_leaf = child
+			tsep += seps[len(node.name)-1]
+		elif step[0] == 'child':
+			stack.append(('placed',step[1],step[2],n,tsep))
+			stack.append(('enter',step[1]))
+		elif step[0] == 'placed':
+			child,node,ln,ltsep = step[1:]
 			nn = (ln + n)*0.5*distn
 			ssep = (ltsep + tsep)*0.5
 			if n-ln == 1:
 				ssep = ltsep
-			child.set_pos((nn+ssep,(len(father.name))/float(mlev-1)))
-	tsep += seps[len(father.name)-1]
+			child.set_pos((nn+ssep,(len(node.name))/float(mlev-1)))
+		else: tsep += seps[len(step[1].name)-1]
 	return n,tsep,last_leaf
 
-def plot_points(father,params,pt_scale,ax):
-	children = father.get_children()
-	children.sort(key = lambda a: -int(a.get_color() == 'y')*a.abundance)
+def post_order(father,key=None):
+	"""(node, children) pairs of the subtree of father, every node after its
+	children, which are in get_children order or sorted by key"""
+	ret = []
+	stack = [(father,None)]
+	while stack:
+		node,children = stack.pop()
+		if children is not None:
+			ret.append((node,children))
+			continue
+		children = node.get_children()
+		if key is not None: children.sort(key = key)
+		stack.append((node,children))
+		stack += [(child,None) for child in reversed(children)]
+	return ret
+
+def plot_points(father,params,pt_scale,pts):
+	for node,children in post_order(father,lambda a: -int(a.get_color() == 'y')*a.abundance):
+		if not node.viz: continue
+		x,r = node.pos[0], node.pos[1]
+		ps = pt_scale[0]+node.abundance/pt_scale[1]+pt_scale[0]
+		col = node.get_color()
+		pw = params['markeredgewidth'] if col == 'y' else params['markeredgewidth']*3.0
+		if x==0 and r==0: pts.append((x,r,ps,col,0.01))
+		else: pts.append((x,r,ps,col,pw))
+	return father.pos[0], father.pos[1]
+
+def plot_connector(father,child,params,depth,lines):
+	"""Line from father to child, in the radial levels"""
+	if len(father.name) < depth-params['radial_start_lev'] or not child.viz: return
 	x,r = father.pos[0], father.pos[1]
-	for i,child in enumerate(children):
-		xc,rc = plot_points(child,params,pt_scale,ax)
-	if not father.viz: return x,r
-	ps = pt_scale[0]+father.abundance/pt_scale[1]+pt_scale[0]
-	col = father.get_color()
-	pw = params['markeredgewidth'] if col == 'y' else params['markeredgewidth']*3.0
-	if x==0 and r==0: ax.plot(x,r, 'o',markersize=ps,color=col,markeredgewidth=0.01,markeredgecolor=params['fore_color'])
-	else: ax.plot(x,r, 'o',markersize=ps,color=col,markeredgewidth=pw,markeredgecolor=params['fore_color'])
-	return x,r
-
-def plot_lines(father,params,depth,ax,xf):
-	children = father.get_children()
+	xc,rc = child.pos[0], child.pos[1]
+	col = params['fore_color'] 
+	lw=params['parents_connector_width']
+	if father.get_color() != 'y' and father.get_color() == child.get_color() and params['colored_connectors']:
+		col = child.get_color()
+		lw *=2.5
+	if col != params['fore_color']:
+		lines.append(([x,xc],[r,rc],params['fore_color'],lw*1.5))
+	lines.append(([x,xc],[r,rc],col,lw))
+
+def plot_node_lines(father,children,params,depth,lines):
+	"""Line from father to its children and, in the inner levels, the arc
+	joining them"""
 	x,r = father.pos[0], father.pos[1]
-	for i,child in enumerate(children):
-		xc,rc = plot_lines(child,params,depth,ax,x)
-		if i == 0: x_first, r_first = xc, rc
-		if len(father.name) >= depth-params['radial_start_lev']: 
-			col = params['fore_color'] 
-			lw=params['parents_connector_width']
-			if not child.viz: continue
-			if father.get_color() != 'y' and father.get_color() == child.get_color() and params['colored_connectors']:
-				col = child.get_color()
-				lw *=2.5
-			if col != params['fore_color']:
-				ax.plot([x,xc],[r,rc],"-",color=params['fore_color'],lw=lw*1.5) 
-			ax.plot([x,xc],[r,rc],"-",color=col,lw=lw)
-	
-	if not father.viz or (len(children) == 1 and not children[0].viz): return x,r 
+	if not father.viz or (len(children) == 1 and not children[0].viz): return
+	if len(children) > 0: x_first, xc, rc = children[0].pos[0], children[-1].pos[0], children[-1].pos[1]
 	if len(father.name) < depth-params['radial_start_lev']:
 		col = params['fore_color'] 
 		lw=params['parents_connector_width']
@@ -225,13 +320,22 @@ def plot_lines(father,params,depth,ax,xf):
 			if len(children) == 0: rc = r
 			xt = x if len(children)>1 else xx 
 			if col != params['fore_color']:
-				ax.plot([x,xt],[r,rc],"-",color=params['fore_color'],lw=lw*1.5)
-			ax.plot([x,xt],[r,rc],"-",color=col,lw=lw)
+				lines.append(([x,xt],[r,rc],params['fore_color'],lw*1.5))
+			lines.append(([x,xt],[r,rc],col,lw))
 	if len(children) > 0 and 1 < len(father.name) < depth-params['radial_start_lev']:
 		xs = arange(x_first,xc,0.01)
 		ys = [rc for t in xs]
-		ax.plot(xs,ys,"-",color=col,lw=params['siblings_connector_width'],markeredgecolor=params['fore_color'])
-	return x,r 
+		if len(xs): lines.append((xs,ys,col,params['siblings_connector_width']))
+
+def plot_lines(father,params,depth,lines,xf):
+	"""Connectors of the subtree of father. The lines of a node follow those
+	of its subtree, and the connector to each child follows that child's."""
+	nodes = post_order(father)
+	parents = dict([(child,node) for node,children in nodes for child in children])
+	for node,children in nodes:
+		plot_node_lines(node,children,params,depth,lines)
+		if node in parents: plot_connector(parents[node],node,params,depth,lines)
+	return father.pos[0], father.pos[1]
 
 def uniqueid():
 	for l in string.lowercase: yield l
@@ -243,44 +347,99 @@ def uniqueid():
 		yield str(i)
 		i += 1
 
-def plot_names(father,params,depth,ax,u_i,seps):
-	children = father.get_children()
-	l = len(father.name)
-	if len(children)==0:
-		if father.prev_leaf == -1 or father.next_leaf == -1:
-			fr_0, fr_1 = father.pos[0], father.pos[0]
-		else: fr_0, fr_1 =  (father.pos[0]+father.prev_leaf.pos[0])*0.5, (father.pos[0]+father.next_leaf.pos[0])*0.5
-        for i,child in enumerate(children):
-                fr,to = plot_names(child,params,depth,ax,u_i,seps)
-                if i == 0: fr_0 = fr
-		fr_1 = to 
-        if father.get_color() != 'y' and params['labeled_start_lev'] < l <= params['labeled_stop_lev']+1:
-                col = father.get_color()
-		dd = params['labeled_stop_lev'] - params['labeled_start_lev'] + 1 
-		de = depth - 1
-		dim = 1.0/float(de)
-		perc_ext = 0.65 if dim > 0.1 else 1.0 
-		clto = (de-l+1)*dim+dim*(dd+1-(l-dd-1))*perc_ext
-		clto = (de-l+1)*dim+dim*(dd-(l-params['labeled_start_lev'])+1)*perc_ext
-		des = float(180.0*(fr_0+fr_1)/np.pi)*0.5-90
-		lab = ""
-		txt = father.last_name
-		if params['abrv_start_lev']  < l <= params['abrv_stop_lev'] + 1:
-			ide = u_i.next()
-			lab = str(ide)+": "+father.last_name 
-			txt = str(ide)
-#		ax.bar(fr_0, clto, width = fr_1-fr_0, bottom = float(l-1)/float(depth-1), alpha = params['alpha'], color=col, edgecolor=col)
-		ax.bar(fr_0, clto, width = fr_1-fr_0, bottom = float(l-1)/float(de), alpha = params['alpha'], color=col, edgecolor=col)
-		ax.bar(0.0, 0.0, width = 0.0, bottom = 0.0, alpha = 1.0, color=col, edgecolor=params['fore_color'],  label=lab)
-		if l <= params['abrv_stop_lev'] + 1:
-			if not params['col_lab']: col = params['fore_color']
-			else: 
-				if col not in colors: col = params['fore_color']
-				else: col = dark_colors[colors.index(col)%len(dark_colors)]
-			ax.text((fr_0+fr_1)*0.5, clto+float(l-1)/float(de)-dim*perc_ext/2.0, txt, size = params['label_font_size'], rotation=des, ha ="center", va="center", color=col)	
-        return fr_0, fr_1
+def clade_extent(l,depth,params):
+	"""Bottom, height and label band of the wedge of a labelled clade of level l"""
+	dd = params['labeled_stop_lev'] - params['labeled_start_lev'] + 1 
+	de = depth - 1
+	dim = 1.0/float(de)
+	perc_ext = 0.65 if dim > 0.1 else 1.0 
+	clto = (de-l+1)*dim+dim*(dd-(l-params['labeled_start_lev'])+1)*perc_ext
+	return float(l-1)/float(de), clto, dim*perc_ext
 
-def draw_tree(out_file,tree,params):
+def plot_names(father,params,depth,ax,u_i,seps,wedges,labels):
+	"""Wedges and labels of the colored clades below father, which span the
+	angles from the first to the last of their leaves"""
+	spans = {}
+	for node,children in post_order(father):
+		l = len(node.name)
+		if len(children)==0:
+			if node.prev_leaf == -1 or node.next_leaf == -1:
+				fr_0, fr_1 = node.pos[0], node.pos[0]
+			else: fr_0, fr_1 =  (node.pos[0]+node.prev_leaf.pos[0])*0.5, (node.pos[0]+node.next_leaf.pos[0])*0.5
+		else: fr_0, fr_1 = spans[children[0]][0], spans[children[-1]][1]
+		for child in children: del spans[child]
+		spans[node] = fr_0, fr_1
+		if node.get_color() != 'y' and params['labeled_start_lev'] < l <= params['labeled_stop_lev']+1:
+			col = node.get_color()
+			bottom,clto,band = clade_extent(l,depth,params)
+			des = float(180.0*(fr_0+fr_1)/np.pi)*0.5-90
+			lab = ""
+			txt = node.last_name
+			if params['abrv_start_lev']  < l <= params['abrv_stop_lev'] + 1:
+				ide = u_i.next()
+				lab = str(ide)+": "+node.last_name 
+				txt = str(ide)
+#			ax.bar(fr_0, clto, width = fr_1-fr_0, bottom = float(l-1)/float(depth-1), alpha = params['alpha'], color=col, edgecolor=col)
+			wedges.append((fr_0,bottom,fr_1-fr_0,clto,col))
+			if lab: labels.append((lab,col))
+			if l <= params['abrv_stop_lev'] + 1:
+				if not params['col_lab']: col = params['fore_color']
+				else: 
+					if col not in colors: col = params['fore_color']
+					else: col = dark_colors[colors.index(col)%len(dark_colors)]
+				ax.text((fr_0+fr_1)*0.5, clto+bottom-band/2.0, txt, size = params['label_font_size'], rotation=des, ha ="center", va="center", color=col)	
+	return spans[father]
+
+def draw_collections(ax,params,lines,pts,wedges):
+	"""Draws the connectors, the nodes and the clade wedges collected by
+	plot_lines, plot_points and plot_names as one collection each, with the
+	stacking and data limits of the single artists they replace"""
+	to_rgba = matplotlib.colors.colorConverter.to_rgba
+	lim = []
+	if wedges:
+		rects = []
+		for x,b,w,h,c in wedges:
+			rects.append(matplotlib.patches.Rectangle((x,b),w,h))
+			lim += [(x,b),(x+w,b),(x+w,b+h),(x,b+h)]
+		for rect in rects: rect.get_path()._interpolation_steps = 100
+		ax.add_collection(matplotlib.collections.PatchCollection(rects,
+			facecolors=[to_rgba(w[4],params['alpha']) for w in wedges],edgecolors=[to_rgba(w[4],params['alpha']) for w in wedges],
+			linewidths=matplotlib.rcParams['patch.linewidth'],zorder=1),autolim=False)
+	if lines:
+		ax.add_collection(matplotlib.collections.LineCollection([zip(xs,ys) for xs,ys,c,lw in lines],
+			colors=[to_rgba(l[2]) for l in lines],linewidths=[l[3] for l in lines],zorder=2),autolim=False)
+		for xs,ys,c,lw in lines: lim += zip(xs,ys)
+	if pts:
+		marker = matplotlib.markers.MarkerStyle('o')
+		ax.add_collection(matplotlib.collections.PathCollection([marker.get_path().transformed(marker.get_transform())],
+			sizes=[p[2]**2 for p in pts],facecolors=[to_rgba(p[3]) for p in pts],edgecolors=params['fore_color'],
+			linewidths=[p[4] for p in pts],offsets=[(p[0],p[1]) for p in pts],transOffset=ax.transData,
+			transform=matplotlib.transforms.IdentityTransform(),zorder=2),autolim=False)
+		lim += [(p[0],p[1]) for p in pts]
+	if lim:
+		ax.update_datalim(lim)
+		ax.autoscale_view()
+
+def output_files(out_file,params):
+	"""(file, format, dpi) of each output of draw_tree. With several formats
+	or dpis, the extension of out_file is replaced by the format of each output
+	and the png outputs are suffixed by their dpi if there are several dpis.
+	Vector formats are saved once."""
+	formats = params['format'] if isinstance(params['format'],list) else [params['format']]
+	dpis = params['dpi'] if isinstance(params['dpi'],list) else [params['dpi']]
+	if len(formats) == 1 and len(dpis) == 1: return [(out_file,formats[0],dpis[0])]
+	base,ext = os.path.splitext(out_file)
+	if ext[1:] not in ["png","svg","pdf"]: base = out_file
+	outs = []
+	for fmt in formats:
+		for dpi in (dpis if fmt == "png" else dpis[:1]):
+			suffix = "_"+str(dpi)+"dpi" if fmt == "png" and len(dpis) > 1 else ""
+			outs.append((base+suffix+"."+fmt,fmt,dpi))
+	return outs
+
+def layout_tree(tree,params):
+	"""Creates the figure and places every node of the tree. Returns the
+	figure, its polar axes, the point scale and the level separations."""
 	plt_size = 7
 	nlev = tree['nlev']
 	pt_scale = (params['min_point_size'],max(1.0,((tree['max_abs']-tree['min_abs']))/(params['max_point_size']-params['min_point_size'])))
@@ -298,17 +457,26 @@ def draw_tree(out_file,tree,params):
 	fig = plt.figure(edgecolor=params['back_color'],facecolor=params['back_color'])
 	ax = fig.add_subplot(111, polar=True, frame_on=False, axis_bgcolor=params['back_color'] )
 	plt.subplots_adjust(right=1.0-params['r_prop'],left=params['l_prop']) 	
-	ax.grid(False)
-	xticks([])
-	yticks([])
+	setup_axes(ax)
 
 	ds = (2.0*np.pi-totseps)/float(nlev[-1])
 
 	add_all_pos(tree['root'],0.0,ds,seps,0.0,depth)
-	
-	plot_lines(tree['root'],params,depth,ax,0)
-	plot_points(tree['root'],params,pt_scale,ax)
-	plot_names(tree['root'],params,depth,ax,uniqueid(),seps)
+	return fig,ax,pt_scale,seps
+
+def setup_axes(ax):
+	ax.grid(False)
+	ax.set_xticks([])
+	ax.set_yticks([])
+
+def draw_clades(ax,tree,params,pt_scale,seps,title):
+	"""Draws the placed tree with its colors, legends and title on ax"""
+	depth = len(tree['nlev'])
+	lines,pts,wedges,labels = [],[],[],[]
+	plot_lines(tree['root'],params,depth,lines,0)
+	plot_points(tree['root'],params,pt_scale,pts)
+	plot_names(tree['root'],params,depth,ax,uniqueid(),seps,wedges,labels)
+	draw_collections(ax,params,lines,pts,wedges)
 
 	r = np.arange(0, 3.0, 0.01)
 	theta = 2*np.pi*r
@@ -316,11 +484,12 @@ def draw_tree(out_file,tree,params):
 	def get_col_attr(x):
     		return hasattr(x, 'set_color') and not hasattr(x, 'set_facecolor')
 
-	h, l = ax.get_legend_handles_labels()
-	if len(l) > 0:
-		leg = ax.legend(bbox_to_anchor=(1.05, 1), frameon=False, loc=2, borderaxespad=0.,prop={'size':params['label_font_size']})
+	# the labels are listed with patches that are not added to the axes, which would lay out one empty bar each
+	if len(labels) > 0:
+		h = [matplotlib.patches.Rectangle((0.0,0.0),0.0,0.0,alpha=1.0,facecolor=col,edgecolor=params['fore_color']) for lab,col in labels]
+		leg = ax.legend(h,[lab for lab,col in labels],bbox_to_anchor=(1.05, 1), frameon=False, loc=2, borderaxespad=0.,prop={'size':params['label_font_size']})
 		if leg != None:
-			gca().add_artist(leg)
+			ax.add_artist(leg)
 			for o in leg.findobj(get_col_attr):
 	                        o.set_color(params['fore_color'])
 	
@@ -328,20 +497,71 @@ def draw_tree(out_file,tree,params):
 	nll = [ax.bar(0.0, 0.0, width = 0.0, bottom = 0.0, color=colors[i%len(colors)], label=c) for i,c in enumerate(cll) if c in tree['classes']]
 	cl = [c for c in cll if c in tree['classes']]
 
-	ax.set_title(params['title'],size=params['title_font_size'],color=params['fore_color'])
+	ax.set_title(title,size=params['title_font_size'],color=params['fore_color'])
 
 	if params['class_legend_vis']:
-		l2 = legend(nll, cl, loc=2, prop={'size':params['class_legend_font_size']}, frameon=False)
+		l2 = ax.legend(nll, cl, loc=2, prop={'size':params['class_legend_font_size']}, frameon=False)
 		if l2 != None:
 			for o in l2.findobj(get_col_attr):
     				o.set_color(params['fore_color'])
 
-	plt.savefig(out_file,format=params['format'],facecolor=params['back_color'],edgecolor=params['fore_color'],dpi=params['dpi'])
-	plt.close()	
+def save_figure(fig,out_file,params):
+	"""Every output is saved from the same figure, with fig.savefig as pyplot.savefig would draw it once more"""
+	outs = output_files(out_file,params)
+	for f,fmt,dpi in outs:
+		fig.savefig(f,format=fmt,facecolor=params['back_color'],edgecolor=params['fore_color'],dpi=dpi)
+	return [o[0] for o in outs]
+
+def draw_tree(out_file,tree,params):
+	fig,ax,pt_scale,seps = layout_tree(tree,params)
+	draw_clades(ax,tree,params,pt_scale,seps,params['title'])
+	outs = save_figure(fig,out_file,params)
+	plt.close(fig)	
+	return outs
+
+def draw_batch(out_files,batch,params,titles=None):
+	"""Draws every timepoint of read_batch on the layout of their union tree,
+	placed once. Only the colors and points change between the figures, which
+	share the same radial scale so that the clades line up across them."""
+	params = dict(params,all_feats=batch['all_feats'])
+	tree = batch['tree']
+	fig,ax,pt_scale,seps = layout_tree(tree,params)
+	depth = len(tree['nlev'])
+	levs = range(params['labeled_start_lev']+1,min(params['labeled_stop_lev']+1,depth)+1)
+	rmax = max([1.0]+[sum(clade_extent(l,depth,params)[:2]) for l in levs])
+	outs = []
+	for i,state in enumerate(batch['states']):
+		set_state(batch,state)
+		ax.cla()
+		setup_axes(ax)
+		draw_clades(ax,tree,params,pt_scale,seps,titles[i] if titles else params['title'])
+		ax.set_ylim(0.0,rmax)
+		outs += save_figure(fig,out_files[i],params)
+	plt.close(fig)
+	return outs
+
+def read_batch_list(list_file,out_dir,params):
+	"""Result files, output files and titles listed for --batch, one result
+	file per line with an optional title after a tab"""
+	inputs,outs,titles = [],[],[]
+	fmt = params['format'][0] if isinstance(params['format'],list) else params['format']
+	with open(list_file) as inp:
+		for line in inp:
+			row = line.rstrip("\r\n").split("\t")
+			if not row[0]: continue
+			inputs.append(row[0])
+			name = os.path.splitext(os.path.basename(row[0]))[0]
+			outs.append(os.path.join(out_dir,name+"."+fmt))
+			titles.append(row[1] if len(row) > 1 and row[1] else params['title'])
+	return inputs,outs,titles
 
 if __name__ == '__main__':
-	params = read_params(sys.argv)
-	params['fore_color'] = 'w' if params['back_color'] == 'k' else 'k'
-	clad_tree = read_data(params['input_file'],params)	
-	draw_tree(params['output_file'],clad_tree,params)
+	params = read_params(sys.argv[1:])
+	if params['batch']:
+		inputs,outs,titles = read_batch_list(params['input_file'],params['output_file'],params)
+		if not os.path.exists(params['output_file']): os.makedirs(params['output_file'])
+		draw_batch(outs,read_batch(inputs,params),params,titles)
+	else:
+		clad_tree = read_data(params['input_file'],params)	
+		draw_tree(params['output_file'],clad_tree,params)
 	
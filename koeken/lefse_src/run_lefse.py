@@ -24,6 +24,8 @@ def read_params(args):
 		help="wheter to perform the Wicoxon step (default 1)")
 	parser.add_argument('-r',dest="rank_tec", metavar='str', choices=['lda','svm'], type=str, default='lda',
 		help="select LDA or SVM for effect size (default LDA)")
+	parser.add_argument('--engine',dest="engine", metavar='str', choices=['np','r'], type=str, default='np',
+		help="select the backend for the statistical tests: native NumPy/SciPy (np) or R through rpy2 (r) (default np)")
 	parser.add_argument('--svm_norm',dest="svm_norm", metavar='int', choices=[0,1], type=int, default=1,
 		help="whether to normalize the data in [0,1] for SVM feature waiting (default 1 strongly suggested)")
         parser.add_argument('-b',dest="n_boots", metavar='int', type=int, default=30,
@@ -44,7 +46,7 @@ def read_params(args):
                 help="set the title of the analysis (default input file without extension)")
         parser.add_argument('-y',dest="multiclass_strat", choices=[0,1], type=int, default=0,
                 help="(for multiclass tasks) set whether the test is performed in a one-against-one ( 1 - more strict!) or in a one-against-all setting ( 0 - less strict) (default 0)")
-        args = parser.parse_args()
+        args = parser.parse_args(args)
           
         params = vars(args)
         if params['title'] == "": params['title'] = params['input_file'].split("/")[-1].split('.')[0]
@@ -52,52 +54,93 @@ def read_params(args):
 
 
 
-if __name__ == '__main__':
-	init()
-	params = read_params(sys.argv)
-	feats,cls,class_sl,subclass_sl,class_hierarchy = load_data(params['input_file'])
-	kord,cls_means = get_class_means(class_sl,feats)
+def test_features_raw(feats,cls,subclass_sl,class_hierarchy,params,multiclass_strats):
+	"""KW p-values of all the features and, for each multiclass strategy, the
+	Wilcoxon outcomes of the features passing KW at anova_alpha. Any cutoff up
+	to anova_alpha can then be applied with select_features."""
+	if params['engine'] == 'np': kw_pvs = dict([(k,pv) for k,(ok,pv) in test_kw_np(cls,feats,params['anova_alpha'],sorted(cls.keys())).items()])
+	else: kw_pvs = dict([(k,test_kw_r(cls,v,params['anova_alpha'],sorted(cls.keys()))[1]) for k,v in feats.items()])
+	wilc_ok = dict([(strat,{}) for strat in multiclass_strats])
+	if not params['wilc']: return kw_pvs,wilc_ok
+	for feat_name,feat_values in feats.items():
+		if not kw_pvs[feat_name] < params['anova_alpha']: continue
+		for strat in multiclass_strats:
+			wilc_ok[strat][feat_name] = test_rep_wilcoxon(subclass_sl,class_hierarchy,feat_values,params['wilcoxon_alpha'],strat,params['strict'],feat_name,params['min_c'],params['only_same_subcl'],params['curv'],params['engine'])
+	return kw_pvs,wilc_ok
+
+def select_features(kw_pvs,wilc_ok,params):
+	"""Applies the anova_alpha cutoff to the results of test_features_raw for
+	one multiclass strategy. Returns the Wilcoxon results, the number of
+	features passing KW and the names of the significant features."""
 	wilcoxon_res = {}
 	kw_n_ok = 0
-	nf = 0
-	for feat_name,feat_values in feats.items():
-		if params['verbose']:
-			print "Testing feature",str(nf),": ",feat_name,
-			nf += 1
-		kw_ok,pv = test_kw_r(cls,feat_values,params['anova_alpha'],sorted(cls.keys()))
-		if not kw_ok:
-			if params['verbose']: print "\tkw ko" 
-			del feats[feat_name]
+	kept = []
+	for nf,(feat_name,pv) in enumerate(sorted(kw_pvs.items())):
+		if params['verbose']: print "Testing feature",str(nf),": ",feat_name,
+		if not pv < params['anova_alpha']:
+			if params['verbose']: print "\tkw ko"
 			wilcoxon_res[feat_name] = "-"
 			continue
 		if params['verbose']: print "\tkw ok\t",
-		
-		if not params['wilc']: continue
-		kw_n_ok += 1	
-		res_wilcoxon_rep = test_rep_wilcoxon_r(subclass_sl,class_hierarchy,feat_values,params['wilcoxon_alpha'],params['multiclass_strat'],params['strict'],feat_name,params['min_c'],params['only_same_subcl'],params['curv'])
-		wilcoxon_res[feat_name] = str(pv) if res_wilcoxon_rep else "-"
-		if not res_wilcoxon_rep:
-			if params['verbose']: print "wilc ko" 
-			del feats[feat_name]
-		elif params['verbose']: print "wilc ok\t"
-		
-	if len(feats) > 0:
-		print "Number of significantly discriminative features:", len(feats), "(", kw_n_ok, ") before internal wilcoxon"
-		if params['lda_abs_th'] < 0.0:
-			lda_res,lda_res_th = dict([(k,0.0) for k,v in feats.items()]), dict([(k,v) for k,v in feats.items()])
-		else:
-			if params['rank_tec'] == 'lda': lda_res,lda_res_th = test_lda_r(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0000000001,params['nlogs'])
-			elif params['rank_tec'] == 'svm': lda_res,lda_res_th = test_svm(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0,params['svm_norm'])	
-			else: lda_res,lda_res_th = dict([(k,0.0) for k,v in feats.items()]), dict([(k,v) for k,v in feats.items()])
-	else: 
-		print "Number of significantly discriminative features:", len(feats), "(", kw_n_ok, ") before internal wilcoxon"
-		print "No features with significant differences between the two classes"
-		lda_res,lda_res_th = {},{}
+		if not params['wilc']:
+			kept.append(feat_name)
+			continue
+		kw_n_ok += 1
+		wilcoxon_res[feat_name] = str(pv) if wilc_ok[feat_name] else "-"
+		if wilc_ok[feat_name]:
+			if params['verbose']: print "wilc ok\t"
+			kept.append(feat_name)
+		elif params['verbose']: print "wilc ko"
+	return wilcoxon_res,kw_n_ok,kept
+
+def test_features(feats,cls,subclass_sl,class_hierarchy,params):
+	"""KW and Wilcoxon steps: returns the Wilcoxon results, the number of
+	features passing KW and the table of the significant features"""
+	kw_pvs,wilc_ok = test_features_raw(feats,cls,subclass_sl,class_hierarchy,params,[params['multiclass_strat']])
+	wilcoxon_res,kw_n_ok,kept = select_features(kw_pvs,wilc_ok[params['multiclass_strat']],params)
+	return wilcoxon_res,kw_n_ok,feats.subset(kept)
+
+def report_tests(n_feats,kw_n_ok):
+	print "Number of significantly discriminative features:", n_feats, "(", kw_n_ok, ") before internal wilcoxon"
+	if n_feats == 0: print "No features with significant differences between the two classes"
+
+def rank_features(feats,cls,class_sl,params):
+	"""Effect size step on the features left by test_features. The scores are
+	not thresholded, so that threshold_features can be applied to them for
+	any cutoff"""
+	if len(feats) == 0 or params['lda_abs_th'] < 0.0: return dict([(k,0.0) for k in feats])
+	if params['rank_tec'] == 'lda': return test_lda(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0000000001,params['nlogs'],params['engine'])[0]
+	if params['rank_tec'] == 'svm': return test_svm(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0,params['svm_norm'])[0]
+	return dict([(k,0.0) for k in feats])
+
+def threshold_features(lda_res,params):
+	"""Features whose absolute effect size is over the threshold (all of them
+	for a negative threshold)"""
+	if params['lda_abs_th'] < 0.0: lda_res_th = dict(lda_res)
+	else: lda_res_th = dict([(k,x) for k,x in lda_res.items() if math.fabs(x) > params['lda_abs_th']])
+	print "Number of discriminative features with abs LDA score >",params['lda_abs_th'],":",len(lda_res_th) 
+	return lda_res_th
+
+def run_lefse(feats,cls,class_sl,subclass_sl,class_hierarchy,params):
+	"""Runs the whole LEfSe analysis on the structures built by format_input
+	and returns the results to be written by save_res"""
+	kord,cls_means = get_class_means(class_sl,feats)
+	wilcoxon_res,kw_n_ok,feats = test_features(feats,cls,subclass_sl,class_hierarchy,params)
+	report_tests(len(feats),kw_n_ok)
+	lda_res = rank_features(feats,cls,class_sl,params)
+	lda_res_th = threshold_features(lda_res,params)
 	outres = {}
 	outres['lda_res_th'] = lda_res_th
 	outres['lda_res'] = lda_res
 	outres['cls_means'] = cls_means
 	outres['cls_means_kord'] = kord
 	outres['wilcox_res'] = wilcoxon_res
-	print "Number of discriminative features with abs LDA score >",params['lda_abs_th'],":",len(lda_res_th) 
+	return outres
+
+
+if __name__ == '__main__':
+	params = read_params(sys.argv[1:])
+	init(params['engine'])
+	feats,cls,class_sl,subclass_sl,class_hierarchy = load_data(params['input_file'])
+	outres = run_lefse(feats,cls,class_sl,subclass_sl,class_hierarchy,params)
 	save_res(outres,params["output_file"])
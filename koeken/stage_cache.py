@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+	stage_cache.py
+	~~~~~~~~~
+	A content-addressed cache for the outputs of the koeken stages.
+	Entries are keyed by a hash of the stage inputs and parameters and the
+	least recently used ones are evicted when the cache grows over its cap.
+	:copyright: (c) 2015 by Thomas W. Battaglia.
+	:license: BSD, see LICENSE for more details.
+"""
+
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+
+
+def stage_key(*parts):
+	"""Hash of the inputs and parameters of a stage. Parts must have a stable repr."""
+	return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def file_digest(file_path):
+	"""Hash of the content of a file"""
+	digest = hashlib.sha1()
+	with open(file_path, 'rb') as inp:
+		for chunk in iter(lambda: inp.read(1 << 20), ''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+class StageCache(object):
+	"""Pickled stage outputs stored as <cache_dir>/<key[:2]>/<key>.pkl.
+	A cache_dir of None disables the cache: every stage is computed."""
+
+	def __init__(self, cache_dir, max_size):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+
+	def path(self, key):
+		return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+	def get(self, key):
+		"""Returns (True, value) if key is cached, (False, None) otherwise"""
+		if self.cache_dir is None:
+			return False, None
+		path = self.path(key)
+		try:
+			with open(path, 'rb') as inp:
+				value = pickle.load(inp)
+		except (IOError, EOFError, pickle.UnpicklingError):
+			return False, None
+		# mark the entry as recently used
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+		return True, value
+
+	def put(self, key, value):
+		"""Stores value under key. The cache may grow over its cap until evict
+		is called, once per run."""
+		if self.cache_dir is None:
+			return
+		path = self.path(key)
+		if not os.path.exists(os.path.dirname(path)):
+			try:
+				os.makedirs(os.path.dirname(path))
+			except OSError:
+				pass
+		# write to a temporary file first so parallel workers never read partial entries
+		fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path))
+		with os.fdopen(fd, 'wb') as out:
+			pickle.dump(value, out, pickle.HIGHEST_PROTOCOL)
+		os.rename(tmp_path, path)
+
+	def fetch(self, key, func, *args):
+		"""Returns (value, cached): the cached value of key, or func(*args)
+		computed and stored on a miss"""
+		hit, value = self.get(key)
+		if hit:
+			return value, True
+		value = func(*args)
+		self.put(key, value)
+		return value, False
+
+	def evict(self):
+		"""Removes the least recently used entries until the cache fits its cap"""
+		if self.cache_dir is None:
+			return
+		entries = []
+		for root, dirs, files in os.walk(self.cache_dir):
+			for f in files:
+				if f.endswith('.pkl'):
+					path = os.path.join(root, f)
+					try:
+						st = os.stat(path)
+					except OSError:
+						continue
+					entries.append((st.st_mtime, st.st_size, path))
+		total = sum(e[1] for e in entries)
+		for mtime, size, path in sorted(entries):
+			if total <= self.max_size:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
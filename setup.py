@@ -32,13 +32,13 @@ setuptools.setup(
     long_description=open('README.rst').read(),
     keywords="Biology Microbiome LEfSe QIIME Formatting Diversity Python Bioinformatics",
 
-    scripts=['koeken/koeken.py', 'koeken/lefse_src/format_input.py', 'koeken/lefse_src/run_lefse.py', 'koeken/lefse_src/lefse.py', 'koeken/lefse_src/plot_cladogram.py', 'koeken/lefse_src/hclust2/hclust2.py', 'koeken/pretty_lefse.py'],
+    scripts=['koeken/koeken.py', 'koeken/lefse_src/format_input.py', 'koeken/lefse_src/run_lefse.py', 'koeken/lefse_src/lefse.py', 'koeken/lefse_src/biom_table.py', 'koeken/lefse_src/plot_cladogram.py', 'koeken/lefse_src/hclust2/hclust2.py', 'koeken/pretty_lefse.py', 'koeken/stage_cache.py'],
 
     cmdclass={'install': CustomInstallPackages},
 
     packages=setuptools.find_packages(),
 
-    install_requires=['rpy2', 'argparse', 'pandas', 'biopython'],
+    install_requires=['rpy2', 'argparse', 'numpy', 'scipy', 'pandas', 'biopython'],
 
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
@@ -0,0 +1,55 @@
+import os,sys,unittest,tempfile,shutil,json
+import numpy
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','koeken','lefse_src'))
+import biom_table
+
+ROWS = [{'id': 'OTU0', 'metadata': {'taxonomy': ['k__Bacteria','p__Firmicutes','c__Bacilli']}},
+	{'id': 'OTU1', 'metadata': {'taxonomy': ['k__Bacteria','p__Firmicutes','c__Clostridia']}},
+	{'id': 'OTU2', 'metadata': {'taxonomy': 'k__Bacteria; p__Bacteroidetes'}},
+	{'id': 'OTU3', 'metadata': {'taxonomy': ['k__Bacteria']}},
+	{'id': 'OTU4', 'metadata': None}]
+COLUMNS = [{'id': 'S0', 'metadata': {'Treatment': 'ctl'}},
+	{'id': 'S1', 'metadata': {'Treatment': 'abx'}},
+	{'id': 'S2', 'metadata': None}]
+COUNTS = numpy.array([[1,0,2],[3,4,0],[0,5,6],[7,0,0],[0,0,8]],dtype=float)
+
+class TestBiomTable(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def write_biom(self,matrix_type):
+		biom = {'id': None, 'format': 'Biological Observation Matrix 1.0.0', 'type': 'OTU table',
+			'matrix_type': matrix_type, 'matrix_element_type': 'float', 'shape': list(COUNTS.shape),
+			'rows': ROWS, 'columns': COLUMNS}
+		if matrix_type == 'sparse': biom['data'] = [[i,j,COUNTS[i,j]] for i,j in zip(*numpy.nonzero(COUNTS))]
+		else: biom['data'] = COUNTS.tolist()
+		biom_fp = os.path.join(self.dir,matrix_type+'.biom')
+		with open(biom_fp,'w') as out:
+			json.dump(biom,out)
+		return biom_fp
+
+	def test_read_biom(self):
+		for matrix_type in ['sparse','dense']:
+			table = biom_table.read_biom(self.write_biom(matrix_type))
+			self.assertEqual(table['observation_ids'],['OTU0','OTU1','OTU2','OTU3','OTU4'])
+			self.assertEqual(table['sample_ids'],['S0','S1','S2'])
+			self.assertEqual(table['sample_metadata'][1],{'Treatment': 'abx'})
+			self.assertEqual(table['observation_metadata'][4],None)
+			self.assertTrue((table['data'].toarray() == COUNTS).all())
+
+	def test_collapse_taxonomy(self):
+		table = biom_table.read_biom(self.write_biom('sparse'))
+		names,counts = biom_table.collapse_taxonomy(table,2)
+		self.assertEqual(names,['Unassigned;Other','k__Bacteria;Other','k__Bacteria;p__Bacteroidetes','k__Bacteria;p__Firmicutes'])
+		self.assertEqual(counts.toarray().tolist(),[[0,0,8],[7,0,0],[0,5,6],[4,4,2]])
+		names,counts = biom_table.collapse_taxonomy(table,1)
+		self.assertEqual(names,['Unassigned','k__Bacteria'])
+		self.assertEqual(counts.toarray().tolist(),[[0,0,8],[11,9,8]])
+		taxa,fine = biom_table.collapse_taxonomy(table,3)
+		self.assertEqual(biom_table.aggregate_taxa(taxa,fine,1)[1].toarray().tolist(),counts.toarray().tolist())
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,110 @@
+import os,sys,unittest,tempfile,shutil
+import numpy
+from scipy import stats
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','koeken','lefse_src'))
+import lefse
+
+def contast_within_classes_or_few_per_class(feats,inds,min_cl,ncl):
+	# the check of every bootstrap draw in the original LEfSe
+	ff = zip(*[v for n,v in feats.items() if n != 'class'])
+	cols = [ff[i] for i in inds]
+	cls = [feats['class'][i] for i in inds]
+	if len(set(cls)) < ncl:
+		return True
+	for c in set(cls):
+		if cls.count(c) < min_cl:
+			return True
+		cols_cl = [x for i,x in enumerate(cols) if cls[i] == c]
+		for i,col in enumerate(zip(*cols_cl)):
+			if (len(set(col)) <= min_cl and min_cl > 1) or (min_cl == 1 and len(set(col)) <= 1):
+				return True
+	return False
+
+class TestBootstrapDraws(unittest.TestCase):
+	def test_rejected_draws(self):
+		rs = numpy.random.RandomState(3)
+		nrej = ndraws = 0
+		for trial in range(10):
+			n,p,ncl = rs.randint(12,60),rs.randint(3,30),rs.randint(2,4)
+			x = rs.randint(0,rs.randint(2,8),size=(n,p)).astype(float)
+			x[rs.rand(n,p) < 0.3] = 0.0
+			yc = rs.randint(0,ncl,size=n)
+			min_cl = rs.randint(1,4)
+			feats = dict([('f%d' % j,list(x[:,j])) for j in range(p)])
+			feats['class'] = list(yc)
+			index = lefse.feasibility_index(x,yc,ncl,min_cl)
+			draws = rs.randint(0,n,size=(200,int(n*0.67)))
+			expected = [contast_within_classes_or_few_per_class(feats,list(d),min_cl,ncl) for d in draws]
+			for first_pairs in [1,16,10**6]:
+				self.assertEqual(list(lefse.rejected_draws(draws,index,first_pairs)),expected)
+			nrej += sum(expected)
+			ndraws += len(draws)
+		self.assertTrue(0 < nrej < ndraws)
+
+class TestStatistics(unittest.TestCase):
+	def setUp(self):
+		rs = numpy.random.RandomState(5)
+		self.cl = numpy.repeat(['a','b','c'],[7,9,8])
+		self.x = rs.randint(0,6,size=(5,len(self.cl))).astype(float)
+		self.x[0] = rs.rand(len(self.cl))
+
+	def test_kw_pvalues(self):
+		pvs = lefse.kw_pvalues(self.cl,self.x)
+		for row,pv in zip(self.x,pvs):
+			expected = stats.kruskal(*[row[self.cl == c] for c in 'abc'])[1]
+			self.assertAlmostEqual(pv,expected,places=12)
+
+	def test_wilcoxon_pvalues(self):
+		sl = {'a': (0,7), 'b': (7,16), 'c': (16,24)}
+		for row in self.x:
+			pvs = lefse.wilcoxon_pvalues(row,sl,['a','b','c'])
+			for i,c1 in enumerate('abc'):
+				for j,c2 in enumerate('abc'):
+					if i == j: continue
+					expected = stats.mannwhitneyu(row[self.cl == c1],row[self.cl == c2],use_continuity=False,alternative='two-sided')[1]
+					self.assertAlmostEqual(pvs[i,j],expected,places=12)
+
+	def test_lda_fit(self):
+		rs = numpy.random.RandomState(7)
+		y = numpy.repeat(['a','b'],[20,25])
+		x = rs.randn(len(y),4)*[1.0,2.0,0.5,1.5]
+		x[y == 'b'] += [1.0,0.0,-0.5,2.0]
+		lev,means,scaling = lefse.lda_fit(x,y,1e-10)
+		self.assertEqual(list(lev),['a','b'])
+		self.assertEqual(scaling.shape,(4,1))
+		xc = x-means[numpy.searchsorted(lev,y)]
+		sw = xc.T.dot(xc)/(len(y)-2.0)
+		w = numpy.linalg.solve(sw,means[0]-means[1])
+		s = scaling[:,0]
+		# the scaling is Sw^-1 (m1-m2) up to its sign, with unit within-class variance
+		self.assertAlmostEqual(abs(s.dot(w))/numpy.sqrt(s.dot(s)*w.dot(w)),1.0,places=10)
+		self.assertAlmostEqual(s.dot(sw).dot(s),1.0,places=10)
+
+class TestDataArray(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_round_trip(self):
+		name,cl = 'k__Bacteria.p__Bact\xc3\xa9ria','tr\xc3\xa9ated'
+		out = {'feats': {name: [1.0,2.0,3.0,4.0], 'k__Bacteria': [5.0,6.0,7.0,8.0]}, 'norm': 1000000.0,
+			'cls': {'class': ('ctl','ctl',cl,cl), 'subclass': ('ctl_subcl','ctl_subcl',cl+'_subcl',cl+'_subcl')},
+			'class_sl': {'ctl': (0,2), cl: (2,4)},
+			'subclass_sl': {'ctl_subcl': (0,2), cl+'_subcl': (2,4)},
+			'class_hierarchy': {'ctl': ['ctl_subcl'], cl: [cl+'_subcl']}}
+		filename = os.path.join(self.dir,'format.txt')
+		lefse.save_data_array(out,filename)
+		feats,cls,class_sl,subclass_sl,class_hierarchy,norm = lefse.load_data(filename,True)
+		self.assertEqual(feats.names,sorted(out['feats'].keys()))
+		self.assertTrue(all([type(k) is str for k in feats.names]))
+		self.assertEqual(list(feats[name]),out['feats'][name])
+		self.assertEqual(cls,out['cls'])
+		self.assertEqual(class_sl,out['class_sl'])
+		self.assertEqual(subclass_sl,out['subclass_sl'])
+		self.assertEqual(class_hierarchy,out['class_hierarchy'])
+		self.assertEqual(norm,out['norm'])
+
+if __name__ == '__main__':
+	unittest.main()
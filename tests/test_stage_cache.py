@@ -0,0 +1,49 @@
+import os,sys,unittest,tempfile,shutil
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','koeken'))
+import stage_cache
+
+class TestStageCache(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_put_get(self):
+		cache = stage_cache.StageCache(self.dir,1 << 20)
+		key = stage_cache.stage_key('koeken','format',[1,2])
+		self.assertEqual(cache.get(key),(False,None))
+		cache.put(key,{'feats': [1.0,2.0]})
+		self.assertEqual(cache.get(key),(True,{'feats': [1.0,2.0]}))
+		self.assertNotEqual(key,stage_cache.stage_key('koeken','format',[2,1]))
+
+	def test_fetch(self):
+		cache = stage_cache.StageCache(self.dir,1 << 20)
+		calls = []
+		def func(x):
+			calls.append(x)
+			return x*2
+		self.assertEqual(cache.fetch('ab01',func,3),(6,False))
+		self.assertEqual(cache.fetch('ab01',func,3),(6,True))
+		self.assertEqual(calls,[3])
+
+	def test_disabled(self):
+		cache = stage_cache.StageCache(None,0)
+		cache.put('ab01',1)
+		self.assertEqual(cache.get('ab01'),(False,None))
+		cache.evict()
+
+	def test_evict(self):
+		cache = stage_cache.StageCache(self.dir,1 << 20)
+		keys = ['%02x' % i + 'cd' for i in range(4)]
+		for i,k in enumerate(keys):
+			cache.put(k,'x'*1000)
+			os.utime(cache.path(k),(1000+i,1000+i))
+		size = os.path.getsize(cache.path(keys[0]))
+		cache.get(keys[0])
+		cache.max_size = 2*size
+		cache.evict()
+		self.assertEqual([cache.get(k)[0] for k in keys],[True,False,False,True])
+
+if __name__ == '__main__':
+	unittest.main()